@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Compare size, encoding and decoding time of the cache codecs
+on a synthetic result set shaped like the target links and metadata.
+
+Usage: python scripts/benchmarks/cache_codecs.py [ROWS]
+"""
+
+import sys
+import timeit
+from datetime import date
+
+from soweego.commons import cache_codecs
+
+
+def links(rows):
+    return [(str(i), 'https://www.example%d.org/artist/%d-some-name' % (i % 100, i)) for i in range(rows)]
+
+
+def metadata(rows):
+    return [(str(i), 'P569', date(1900 + i % 100, 1 + i % 12, 1 + i % 28), 11) for i in range(rows)]
+
+
+def benchmark(name, items, repeat=3):
+    print('%s, %d rows' % (name, len(items)))
+    for codec in cache_codecs.CODECS.values():
+        codec_items = items
+        # Dates are not JSON-serializable: only plain JSON gets strings instead
+        if codec.name == 'json' and name == 'metadata':
+            codec_items = [(i, p, d.isoformat(), precision)
+                           for i, p, d, precision in items]
+        payload = codec.encode_items(codec_items)
+        encode = min(timeit.repeat(
+            lambda: codec.encode_items(codec_items), number=1, repeat=repeat))
+        decode = min(timeit.repeat(
+            lambda: codec.decode_items(payload), number=1, repeat=repeat))
+        # Whether the original rows come back, tuples and dates included
+        round_trip = codec.decode_items(payload) == items
+        print('  %-8s %12d bytes  encode %.3fs  decode %.3fs  round-trip %s' %
+              (codec.name, len(payload), encode, decode, 'yes' if round_trip else 'no'))
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    benchmark('links', links(rows))
+    benchmark('metadata', metadata(rows))
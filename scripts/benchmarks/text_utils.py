@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Compare names per second of one-by-one and batch tokenization
+and normalization on a synthetic list of names with repetitions,
+as in name variations and aliases.
+
+Usage: python scripts/benchmarks/text_utils.py [NAMES]
+"""
+
+import random
+import sys
+import timeit
+
+from soweego.commons import text_utils
+
+FIRST_NAMES = ['Jöhn', 'Mary', 'Paul', 'Jane', 'George', 'Ringo', 'Anna', 'María', 'Luca', 'Marco',
+               'Björk', 'Zoë', 'Ivan', 'Олег', 'Françoise', 'Søren']
+LAST_NAMES = ['Smith', 'Doe', 'Rossi', 'Bianchi', 'Lennon', 'Starr', 'Jones', 'Brown',
+              'Dvořák', 'Müller', 'Łukasiewicz', 'Петров', 'O\'Brien', 'García']
+
+
+def names(amount, seed=1984):
+    random.seed(seed)
+    return ['%s %s & The %s Band' % (random.choice(FIRST_NAMES), random.choice(LAST_NAMES), random.choice(LAST_NAMES))
+            for _ in range(amount)]
+
+
+def benchmark(label, function, amount, repeat=3):
+    # Memo caches start empty at each run
+    seconds = min(timeit.repeat(function, setup=_clear_memo,
+                                number=1, repeat=repeat))
+    print('  %-28s %12.0f names/s' % (label, amount / seconds))
+
+
+def _clear_memo():
+    text_utils._tokenize_memo.cache_clear()
+    text_utils._normalize_memo.cache_clear()
+
+
+if __name__ == '__main__':
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    texts = names(amount)
+    print('%d names, %d distinct' % (amount, len(set(texts))))
+    benchmark('tokenize', lambda: [
+              text_utils.tokenize(text) for text in texts], amount)
+    benchmark('tokenize_many', lambda: text_utils.tokenize_many(texts), amount)
+    benchmark('normalize', lambda: [
+              text_utils.normalize(text) for text in texts], amount)
+    benchmark('normalize_many',
+              lambda: text_utils.normalize_many(texts), amount)
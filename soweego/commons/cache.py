@@ -2,7 +2,23 @@
 # -*- coding: utf-8 -*-
 # Adapted from https://github.com/Wikidata/StrepHit/blob/master/strephit/commons/cache.py
 
-"""Caching facility"""
+"""Caching facility.
+
+Entries are stored by a pluggable backend, see :mod:`soweego.commons.cache_backends`.
+The default one is a single SQLite file with least recently used eviction,
+under ``BASE_DIR`` in the folder shared across runs.
+Payloads are serialized by the codec named in ``CODEC``,
+see :mod:`soweego.commons.cache_codecs`.
+Results of cached generators are stored as streams of chunks,
+written while the generator is consumed and replayed lazily.
+
+Results computed from a target catalog are tagged with the catalog
+data version recorded by the importer, so a new dump invalidates them.
+
+Each process keeps the most recently used values in memory, in front of the backend,
+while streams are always replayed from the backend.
+Usage statistics are accumulated across runs, see ``commons cache_stats``.
+"""
 
 __author__ = 'Marco Fossati'
 __email__ = 'fossati@spaziodati.eu'
@@ -10,27 +26,129 @@ __version__ = '1.0'
 __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, Hjfocs'
 
-import hashlib
+import atexit
+import fcntl
+import inspect
 import json
+import logging
 import os
+import sys
 import tempfile
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+from typing import Iterable, Iterator
 
-BASE_DIR = os.path.join(tempfile.gettempdir(), 'soweego_cache')
+import click
+from soweego.commons import cache_codecs
+from soweego.commons.cache_backends import (DEFAULT_MAX_BYTES, CacheBackend,
+                                            SQLiteBackend)
+
+# Persisted across runs: the Docker setup mounts it from the host,
+# see docker-compose.dev.yml. Override with the SOWEEGO_SHARED_DIR environment variable
+DOCKER_SHARED_DIR = '/app/shared'
+SHARED_DIR = os.environ.get('SOWEEGO_SHARED_DIR') or (
+    DOCKER_SHARED_DIR if os.path.isdir(DOCKER_SHARED_DIR)
+    else os.path.join(os.path.expanduser('~'), '.soweego'))
+BASE_DIR = os.path.join(SHARED_DIR, 'cache')
+DB_PATH = os.path.join(BASE_DIR, 'cache.sqlite3')
+# {catalog: data version}, written by the importer
+CATALOG_VERSIONS_PATH = os.path.join(BASE_DIR, 'catalog_versions.json')
+MAX_BYTES = DEFAULT_MAX_BYTES
 ENABLED = True
+# Codec of new entries, see soweego.commons.cache_codecs.CODECS.
+# Pickles are only read back from storages that other users cannot write to
+CODEC = 'zjson'
+# Amount of records of a cached generator stored together
+STREAM_CHUNK_SIZE = 10000
+# Estimated size of the decoded values each process keeps in memory.
+# Streams are never kept there: they are replayed from the backend
+MEMORY_MAX_BYTES = 64 * 1024 ** 2
+# Usage statistics of all the runs
+STATS_PATH = os.path.join(BASE_DIR, 'stats.json')
+STATS_KEYS = ('memory_hits', 'backend_hits', 'misses', 'bytes_read',
+              'bytes_written', 'decode_seconds', 'encode_seconds')
+
+LOGGER = logging.getLogger(__name__)
+
+_backend = None
+
+
+class _MemoryTier():
+
+    """Least recently used values, weighted by their estimated size in memory"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
 
+    def get(self, key):
+        """Return a ``(found, value)`` pair."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[0]
 
-def _hash_for(key):
-    return hashlib.sha1(key.encode('utf8')).hexdigest()
+    def put(self, key, value):
+        self.discard(key)
+        size = _estimate_size(value, self.max_bytes)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
 
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
 
-def _path_for(hashed_key):
-    """ Computes the path in which the given key should be stored.
 
-        :return: tuple (full path, base path, file name)
-        :rtype: tuple
+def _estimate_size(value, limit):
+    # Objects and the containers holding them, each counted once.
+    # Stops early once above the limit
+    size, seen, stack = 0, set(), [value]
+    while stack and size <= limit:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+_memory = _MemoryTier(MEMORY_MAX_BYTES)
+_stats = Counter()
+
+
+def get_backend() -> CacheBackend:
+    """Return the current cache backend.
+    Unless set via :func:`set_backend`, a :class:`SQLiteBackend`
+    storing at most ``MAX_BYTES`` into ``DB_PATH``.
     """
-    loc = os.path.join(BASE_DIR, hashed_key[:3])
-    return os.path.join(loc, hashed_key), loc, hashed_key
+    global _backend
+    if _backend is None:
+        _backend = SQLiteBackend(DB_PATH, MAX_BYTES)
+    return _backend
+
+
+def set_backend(backend: CacheBackend):
+    """ Replaces the cache backend
+
+        :param backend: a :class:`CacheBackend` instance, e.g.,
+         a :class:`FileBackend` for the legacy file-per-key layout
+    """
+    global _backend
+    _backend = backend
 
 
 def get_value(key, default=None):
@@ -40,7 +158,8 @@ def get_value(key, default=None):
         :param default: Default value to return if the
          key is not in the cache
         :return: The item associated with the given key or
-         the default value
+         the default value. Values kept in memory are shared,
+         so they must not be modified
 
         Sample usage:
 
@@ -56,16 +175,11 @@ def get_value(key, default=None):
     if not ENABLED:
         return default
 
-    hashed = _hash_for(key)
-    loc, _, _ = _path_for(hashed)
-    if os.path.exists(loc):
-        with open(loc) as f:
-            stored_key = f.readline()[:-1]
-            if stored_key == key:
-                return json.loads(f.read())
-            return get_value(key + hashed, default)
-    else:
+    found, value = _load_value(key)
+    if not found:
+        _stats['misses'] += 1
         return default
+    return value
 
 
 def set_value(key, value, overwrite=True):
@@ -73,7 +187,7 @@ def set_value(key, value, overwrite=True):
 
         :param key: Unique key used to identify the idem.
         :param value: Value to store in the cache. Must be
-        a generator of JSON-dumpable objects
+        a generator of objects supported by the ``CODEC``
         :param overwrite: Whether to overwrite the previous
         value associated with the key (if any)
         :return: Nothing
@@ -92,32 +206,239 @@ def set_value(key, value, overwrite=True):
     if not ENABLED:
         return
 
-    hashed = _hash_for(key)
-    loc, path, _ = _path_for(hashed)
-    if not os.path.exists(loc):
-        if not os.path.exists(path):
-            try:
-                os.makedirs(path)
-            except OSError:
-                pass
-
-        with open(loc, 'w') as f:
-            f.write(key + '\n')
-            f.write(json.dumps([obj for obj in value]))
-    else:
-        with open(loc, 'r+') as f:
-            stored_key = f.readline()[:-1]
-            if stored_key == key:
-                if overwrite:
-                    f.write(json.dumps([obj for obj in value]))
-                    f.truncate()
-                return
-        set_value(key + hashed, value, overwrite)
-
-
-def cached(function):
+    backend = get_backend()
+    if not overwrite and backend.contains(key):
+        return
+    codec = cache_codecs.get_codec(CODEC)
+    start = time.perf_counter()
+    payload = cache_codecs.add_header(
+        codec, codec.encode([obj for obj in value]))
+    _stats['encode_seconds'] += time.perf_counter() - start
+    _stats['bytes_written'] += len(payload)
+    backend.set(key, payload)
+    _memory.discard(key)
+
+
+def get_stream(key) -> Iterator:
+    """ Retrieves a stream of items from the cache
+
+        :param key: Key of the stream
+        :return: a generator lazily yielding the stored items,
+         or ``None`` if the key is not in the cache
+    """
+    if not ENABLED:
+        return None
+
+    stream = _load_stream(key)
+    if stream is None:
+        _stats['misses'] += 1
+    return stream
+
+
+def set_stream(key, items: Iterable) -> Iterator:
+    """ Stores a stream of items in the cache under the given key,
+        while they are consumed
+
+        :param key: Unique key used to identify the stream
+        :param items: Iterable of objects supported by the ``CODEC``
+        :return: a generator yielding the given items. The stream
+         is only stored once the generator is exhausted
+
+        Sample usage:
+
+        >>> from soweego.commons import cache
+        >>> list(cache.set_stream('kk_stream', iter([(1, 'a'), (2, 'b')])))
+        [(1, 'a'), (2, 'b')]
+        >>> list(cache.get_stream('kk_stream'))
+        [(1, 'a'), (2, 'b')]
+    """
+    if not ENABLED:
+        yield from items
+        return
+
+    writer = get_backend().open_stream(key)
+    buffer = []
+    try:
+        for item in items:
+            buffer.append(item)
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                writer.append(_encode_chunk(buffer))
+                buffer = []
+            yield item
+        if buffer:
+            writer.append(_encode_chunk(buffer))
+    except BaseException:
+        # Includes consumers that stop early: partial streams are never stored
+        writer.abort()
+        raise
+    writer.commit()
+    _memory.discard(key)
+
+
+def get_stats() -> dict:
+    """ Returns the usage statistics of the cache in the current process """
+    return {key: _stats[key] for key in STATS_KEYS}
+
+
+def _load_value(key):
+    found, value = _memory.get(key)
+    if found:
+        _stats['memory_hits'] += 1
+        return True, value
+
+    payload = get_backend().get(key)
+    if payload is None:
+        return False, None
+    _stats['backend_hits'] += 1
+    _stats['bytes_read'] += len(payload)
+    start = time.perf_counter()
+    codec, payload = cache_codecs.split_header(payload)
+    if not _can_decode(codec):
+        LOGGER.warning('Skipping cache entry: %s', _UNTRUSTED_STORAGE_MESSAGE)
+        return False, None
+    value = codec.decode(payload)
+    _stats['decode_seconds'] += time.perf_counter() - start
+    _memory.put(key, value)
+    return True, value
+
+
+def _load_stream(key):
+    chunks = get_backend().get_stream(key)
+    if chunks is None:
+        return None
+    _stats['backend_hits'] += 1
+    return _replay(chunks)
+
+
+_UNTRUSTED_STORAGE_MESSAGE = ('refusing to load a pickle from a cache storage that other users can write to. '
+                              'Make it owned by the current user with mode 0700')
+
+
+def _can_decode(codec):
+    return not codec.trusted_storage_only or get_backend().is_private()
+
+
+def _encode_chunk(items):
+    codec = cache_codecs.get_codec(CODEC)
+    start = time.perf_counter()
+    chunk = cache_codecs.add_header(codec, codec.encode_items(items))
+    _stats['encode_seconds'] += time.perf_counter() - start
+    _stats['bytes_written'] += len(chunk)
+    return chunk
+
+
+def _replay(chunks):
+    for chunk in chunks:
+        _stats['bytes_read'] += len(chunk)
+        start = time.perf_counter()
+        codec, chunk = cache_codecs.split_header(chunk)
+        if not _can_decode(codec):
+            raise ValueError(_UNTRUSTED_STORAGE_MESSAGE)
+        decoded = codec.decode_items(chunk)
+        _stats['decode_seconds'] += time.perf_counter() - start
+        yield from decoded
+
+
+@atexit.register
+def flush_stats():
+    """ Adds the usage statistics of the current process to the ones
+        accumulated across runs, see ``commons cache_stats``.
+        Called at exit, but processes exiting without running
+        ``atexit`` hooks, e.g., multiprocessing pool workers, must call it
+    """
+    if not _stats:
+        return
+    try:
+        os.makedirs(BASE_DIR, mode=0o700, exist_ok=True)
+        # Processes sharing the cache directory update the statistics one at a time
+        with open(STATS_PATH + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = _read_stats()
+            totals.update(_stats)
+            with open(STATS_PATH, 'w') as f:
+                json.dump(dict(totals), f)
+        _stats.clear()
+    except OSError as error:
+        LOGGER.warning('Could not save cache statistics: %s', error)
+
+
+def _read_stats():
+    try:
+        with open(STATS_PATH) as f:
+            return Counter(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return Counter()
+
+
+@click.command()
+@click.option('--reset', is_flag=True, help='Reset the statistics after showing them.')
+def stats_cli(reset):
+    """Show cache usage statistics accumulated across runs."""
+    # Include the statistics of this process, if any
+    flush_stats()
+    stats = _read_stats()
+    hits = stats['memory_hits'] + stats['backend_hits']
+    lookups = hits + stats['misses']
+    click.echo('Lookups: %d' % lookups)
+    click.echo('Hits: %d (memory: %d, backend: %d), hit ratio: %.3f' % (
+        hits, stats['memory_hits'], stats['backend_hits'], hits / lookups if lookups else 0))
+    click.echo('Misses: %d' % stats['misses'])
+    click.echo('Read: %d bytes, decoded in %.3f seconds' %
+               (stats['bytes_read'], stats['decode_seconds']))
+    click.echo('Written: %d bytes, encoded in %.3f seconds' %
+               (stats['bytes_written'], stats['encode_seconds']))
+    entries, size = get_backend().usage()
+    click.echo('Backend: %s, %d entries, %d bytes' %
+               (type(get_backend()).__name__, entries, size))
+    if reset:
+        with open(STATS_PATH + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            os.remove(STATS_PATH)
+        LOGGER.info('Cache statistics reset')
+
+
+def get_catalog_version(catalog) -> str:
+    """ Returns the data version of the given target catalog,
+        ``None`` if the importer never recorded it
+    """
+    try:
+        with open(CATALOG_VERSIONS_PATH) as f:
+            return json.load(f).get(catalog)
+    except FileNotFoundError:
+        return None
+
+
+def set_catalog_version(catalog, version):
+    """ Records the data version of the given target catalog.
+        Cached results tagged with a different version become stale
+
+        :param catalog: a target catalog, e.g., ``discogs``
+        :param version: any string identifying the catalog data,
+         e.g., the dump date
+    """
+    versions = {}
+    if os.path.exists(CATALOG_VERSIONS_PATH):
+        with open(CATALOG_VERSIONS_PATH) as f:
+            versions = json.load(f)
+    versions[catalog] = version
+    os.makedirs(BASE_DIR, mode=0o700, exist_ok=True)
+    # Readers never see a partially written file
+    descriptor, temporary = tempfile.mkstemp(dir=BASE_DIR)
+    with os.fdopen(descriptor, 'w') as f:
+        json.dump(versions, f)
+    os.replace(temporary, CATALOG_VERSIONS_PATH)
+    LOGGER.info('Cached %s results are now tagged with data version %s',
+                catalog, version)
+
+
+def cached(function=None, catalog_arg=None, ttl=None):
     """ Decorator to cache function results based on its arguments
 
+    :param catalog_arg: name of the function argument holding a target
+     catalog. Results are tagged with the catalog data version,
+     see :func:`set_catalog_version`, and become stale when it changes
+    :param ttl: seconds after which results become stale
+
     Sample usage:
 
     >>> from soweego.commons.cache import cached
@@ -132,14 +453,47 @@ def cached(function):
     >>> f(10)
     20
 
+    Generators are cached as streams, see :func:`set_stream`.
+
+    Stale results are skipped and evicted when accessed,
+    or by the cache backend when it runs out of space.
     """
+    if function is None:
+        return lambda function: cached(function, catalog_arg, ttl)
+
+    @wraps(function)
     def wrapper(*args, **kwargs):
         key = str([function.__module__]) + \
             function.__name__ + str(args) + str(kwargs)
-        res = get_value(key)
-        if res is None:
-            res = function(*args, **kwargs)
-            if res is not None:
-                set_value(key, res)
+        if catalog_arg is not None:
+            catalog = inspect.signature(function).bind(
+                *args, **kwargs).arguments.get(catalog_arg)
+            # Results of previous versions are never looked up again
+            key += ' [%s data version: %s]' % (
+                catalog, get_catalog_version(catalog))
+        if ENABLED:
+            if ttl is not None:
+                _evict_if_expired(key, ttl)
+            stream = _load_stream(key)
+            if stream is not None:
+                return stream
+            found, res = _load_value(key)
+            if found:
+                return res
+            _stats['misses'] += 1
+        res = function(*args, **kwargs)
+        if isinstance(res, Iterator):
+            return set_stream(key, res)
+        if res is not None:
+            set_value(key, res)
         return res
     return wrapper
+
+
+def _evict_if_expired(key, ttl):
+    backend = get_backend()
+    created = backend.created(key)
+    if created is not None and time.time() - created > ttl:
+        LOGGER.debug('Evicting cache entry older than %d seconds: %s', ttl, key)
+        backend.delete(key)
+        _memory.discard(key)
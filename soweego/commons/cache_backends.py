@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Storages for the caching facility, see :mod:`soweego.commons.cache`.
+
+A backend maps string keys to byte payloads and knows nothing about
+how values are serialized.
+A key holds either a single payload or a stream of payload chunks,
+written incrementally and read lazily.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import atexit
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+import struct
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+LOGGER = logging.getLogger(__name__)
+
+# 2 GiB
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# Seconds to wait for another process holding the write lock
+LOCK_TIMEOUT = 60
+# Stream chunks are prefixed by their length as an 8-byte unsigned integer
+CHUNK_LENGTH = struct.Struct('>Q')
+STREAM_SUFFIX = '.stream'
+# Bump when the schema changes: cache files with an older one are wiped
+SQLITE_SCHEMA_VERSION = 3
+# Streamed entries have no value, their chunks are the records of a generation.
+# Streams being written have a placeholder entry, evicted if never committed
+SQLITE_SCHEMA = '''
+CREATE TABLE entries (
+    key TEXT PRIMARY KEY,
+    value BLOB,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    created REAL NOT NULL,
+    generation TEXT
+);
+CREATE INDEX entries_accessed ON entries (accessed);
+CREATE TABLE records (
+    generation TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (generation, seq)
+);
+'''
+PENDING_KEY_PREFIX = '\0pending '
+# Hits update the access time of their entry in batches, written
+# when this many are pending, or every this many seconds, or before evicting.
+# Readers would otherwise queue up for the write lock on every hit
+TOUCH_BATCH_SIZE = 1000
+TOUCH_INTERVAL = 60
+
+
+class CacheBackend():
+
+    """Interface of cache storages"""
+
+    def get(self, key: str) -> bytes:
+        """Return the payload stored under the given key, ``None`` if missing."""
+        raise NotImplementedError
+
+    def set(self, key: str, payload: bytes) -> None:
+        """Store the payload under the given key, replacing any previous one."""
+        raise NotImplementedError
+
+    def get_stream(self, key: str) -> Iterator[bytes]:
+        """Return a lazy iterator over the chunks stored under the given key,
+        ``None`` if missing.
+        """
+        raise NotImplementedError
+
+    def open_stream(self, key: str) -> 'StreamWriter':
+        """Start writing a stream of chunks under the given key.
+        Readers keep seeing the previous entry until the stream is committed.
+        """
+        raise NotImplementedError
+
+    def contains(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def created(self, key: str) -> float:
+        """Return when the entry under the given key was written,
+        as seconds since the epoch, ``None`` if missing.
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def usage(self) -> tuple:
+        """Return the amount of stored entries and their total size in bytes."""
+        raise NotImplementedError
+
+    def is_private(self) -> bool:
+        """Whether only the current user can write to the storage."""
+        return False
+
+
+class StreamWriter():
+
+    """Incremental writer of a streamed entry"""
+
+    def append(self, chunk: bytes) -> None:
+        raise NotImplementedError
+
+    def commit(self) -> None:
+        """Make the stream visible under its key."""
+        raise NotImplementedError
+
+    def abort(self) -> None:
+        """Discard the stream."""
+        raise NotImplementedError
+
+
+class FileBackend(CacheBackend):
+
+    """One file per key under ``base_dir/<sha1[:3]>/<sha1>``.
+
+    Each file starts with the full key on the first line, followed by the payload.
+    Streams go to the same path plus ``STREAM_SUFFIX``, as length-prefixed chunks.
+    Neither size limits nor eviction apply.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def is_private(self):
+        return _is_private(self.base_dir)
+
+    def get(self, key):
+        f = self._open(key, self._path_for(key))
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def set(self, key, payload):
+        writer = self._FileStreamWriter(
+            key, self._path_for(key), self._path_for(key) + STREAM_SUFFIX)
+        writer.file.write(payload)
+        writer.commit()
+
+    def get_stream(self, key):
+        f = self._open(key, self._path_for(key) + STREAM_SUFFIX)
+        if f is None:
+            return None
+        return self._read_chunks(f)
+
+    def open_stream(self, key):
+        return self._FileStreamWriter(
+            key, self._path_for(key) + STREAM_SUFFIX, self._path_for(key))
+
+    def created(self, key):
+        for location in (self._path_for(key), self._path_for(key) + STREAM_SUFFIX):
+            f = self._open(key, location)
+            if f is not None:
+                f.close()
+                return os.path.getmtime(location)
+        return None
+
+    def delete(self, key):
+        for location in (self._path_for(key), self._path_for(key) + STREAM_SUFFIX):
+            f = self._open(key, location)
+            if f is not None:
+                f.close()
+                os.remove(location)
+
+    def clear(self):
+        for folder, _, files in os.walk(self.base_dir):
+            for file_name in files:
+                os.remove(os.path.join(folder, file_name))
+
+    def usage(self):
+        entries, size = 0, 0
+        for folder, _, files in os.walk(self.base_dir):
+            for file_name in files:
+                entries += 1
+                size += os.path.getsize(os.path.join(folder, file_name))
+        return entries, size
+
+    def _path_for(self, key):
+        hashed = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.base_dir, hashed[:3], hashed)
+
+    @staticmethod
+    def _open(key, location):
+        try:
+            f = open(location, 'rb')
+        except FileNotFoundError:
+            return None
+        stored_key = f.readline()[:-1].decode('utf8')
+        # Hash collision: the file belongs to another key
+        if stored_key != key:
+            f.close()
+            return None
+        return f
+
+    @staticmethod
+    def _read_chunks(f):
+        with f:
+            while True:
+                prefix = f.read(CHUNK_LENGTH.size)
+                if not prefix:
+                    return
+                length, = CHUNK_LENGTH.unpack(prefix)
+                yield f.read(length)
+
+    class _FileStreamWriter(StreamWriter):
+
+        def __init__(self, key, location, replaced):
+            self.location = location
+            # A key holds either a payload or a stream
+            self.replaced = replaced
+            folder = os.path.dirname(location)
+            os.makedirs(folder, mode=0o700, exist_ok=True)
+            # Readers never see a partially written file.
+            # On a hash collision, the last written key wins
+            descriptor, self.temporary = tempfile.mkstemp(dir=folder)
+            self.file = os.fdopen(descriptor, 'wb')
+            self.file.write(key.encode('utf8') + b'\n')
+
+        def append(self, chunk):
+            self.file.write(CHUNK_LENGTH.pack(len(chunk)))
+            self.file.write(chunk)
+
+        def commit(self):
+            try:
+                self.file.close()
+                os.replace(self.temporary, self.location)
+            except:
+                self.abort()
+                raise
+            if os.path.exists(self.replaced):
+                os.remove(self.replaced)
+
+        def abort(self):
+            self.file.close()
+            if os.path.exists(self.temporary):
+                os.remove(self.temporary)
+
+
+class SQLiteBackend(CacheBackend):
+
+    """All the entries in a single SQLite file, within a budget of ``max_bytes``.
+
+    When the budget is exceeded, the least recently used entries are evicted.
+    Each write is a transaction, so several processes can safely share the same file.
+    Access times are written lazily, so recent hits of other processes
+    may be missed when picking the entries to evict.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._connection = None
+        self._pid = None
+        # {key: access time} not yet written
+        self._touched = {}
+        self._touched_flush = time.time()
+        atexit.register(self._flush_touches)
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM entries WHERE key = ? AND generation IS NULL', (key,)).fetchone()
+        if row is None:
+            return None
+        self._touch(key)
+        return row[0]
+
+    def set(self, key, payload):
+        with self._transaction() as connection:
+            self._delete(connection, key)
+            now = time.time()
+            connection.execute('INSERT INTO entries (key, value, size, accessed, created) VALUES (?, ?, ?, ?, ?)',
+                               (key, payload, len(payload), now, now))
+            self._evict(connection)
+
+    def get_stream(self, key):
+        row = self._connect().execute(
+            'SELECT generation FROM entries WHERE key = ? AND generation IS NOT NULL', (key,)).fetchone()
+        if row is None:
+            return None
+        self._touch(key)
+        return self._read_records(row[0])
+
+    def open_stream(self, key):
+        return self._SQLiteStreamWriter(self, key)
+
+    def contains(self, key):
+        return self._connect().execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+
+    def created(self, key):
+        row = self._connect().execute(
+            'SELECT created FROM entries WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def delete(self, key):
+        with self._transaction() as connection:
+            self._delete(connection, key)
+
+    def clear(self):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM records')
+
+    def usage(self):
+        return tuple(self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone())
+
+    def is_private(self):
+        # Only the owner of the folder can create or replace the database files
+        return _is_private(os.path.dirname(os.path.abspath(self.path)))
+
+    def _read_records(self, generation):
+        # A dedicated connection keeps a consistent snapshot of the stream
+        # for the whole replay, even if the entry gets replaced meanwhile
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        try:
+            for value, in connection.execute('SELECT value FROM records WHERE generation = ? ORDER BY seq', (generation,)):
+                yield value
+        finally:
+            connection.close()
+
+    def _touch(self, key):
+        now = time.time()
+        self._touched[key] = now
+        if len(self._touched) >= TOUCH_BATCH_SIZE or now - self._touched_flush >= TOUCH_INTERVAL:
+            self._flush_touches()
+
+    def _flush_touches(self):
+        if not self._touched:
+            return
+        with self._transaction() as connection:
+            self._write_touches(connection)
+
+    def _write_touches(self, connection):
+        connection.executemany('UPDATE entries SET accessed = ? WHERE key = ?',
+                               ((accessed, key) for key, accessed in self._touched.items()))
+        self._touched = {}
+        self._touched_flush = time.time()
+
+    @staticmethod
+    def _delete(connection, key):
+        row = connection.execute(
+            'SELECT generation FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return
+        if row[0] is not None:
+            connection.execute(
+                'DELETE FROM records WHERE generation = ?', (row[0],))
+        connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def _evict(self, connection):
+        if self._touched:
+            self._write_touches(connection)
+        total, = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in connection.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            evicted.append(key)
+            total -= size
+            if total <= self.max_bytes:
+                break
+        for key in evicted:
+            self._delete(connection, key)
+        LOGGER.info('Evicted %d least recently used cache entries to fit into %d bytes',
+                    len(evicted), self.max_bytes)
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        # Take the write lock upfront, so that concurrent writers queue up
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def _connect(self):
+        # SQLite connections must not cross a fork
+        if self._connection is None or self._pid != os.getpid():
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, mode=0o700, exist_ok=True)
+            # Transactions are handled explicitly
+            self._connection = sqlite3.connect(
+                self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+            # Readers do not block the writer and vice versa
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._pid = os.getpid()
+            with self._transaction() as connection:
+                version, = connection.execute(
+                    'PRAGMA user_version').fetchone()
+                if version != SQLITE_SCHEMA_VERSION:
+                    LOGGER.info(
+                        "Creating cache tables in '%s', schema version %d", self.path, SQLITE_SCHEMA_VERSION)
+                    connection.execute('DROP TABLE IF EXISTS entries')
+                    connection.execute('DROP TABLE IF EXISTS records')
+                    # executescript would commit the transaction
+                    for statement in filter(None, map(str.strip, SQLITE_SCHEMA.split(';'))):
+                        connection.execute(statement)
+                    connection.execute('PRAGMA user_version = %d' %
+                                       SQLITE_SCHEMA_VERSION)
+        return self._connection
+
+    class _SQLiteStreamWriter(StreamWriter):
+
+        def __init__(self, backend, key):
+            self.backend = backend
+            self.key = key
+            self.generation = uuid.uuid4().hex
+            self.placeholder = PENDING_KEY_PREFIX + self.generation
+            self.seq = 0
+            self.size = 0
+            with backend._transaction() as connection:
+                now = time.time()
+                connection.execute('INSERT INTO entries (key, size, accessed, created, generation) VALUES (?, 0, ?, ?, ?)',
+                                   (self.placeholder, now, now, self.generation))
+
+        def append(self, chunk):
+            self.size += len(chunk)
+            with self.backend._transaction() as connection:
+                connection.execute('INSERT INTO records (generation, seq, value) VALUES (?, ?, ?)',
+                                   (self.generation, self.seq, chunk))
+                connection.execute('UPDATE entries SET size = ?, accessed = ? WHERE key = ?',
+                                   (self.size, time.time(), self.placeholder))
+                self.backend._evict(connection)
+            self.seq += 1
+
+        def commit(self):
+            with self.backend._transaction() as connection:
+                if not connection.execute('SELECT 1 FROM entries WHERE key = ?', (self.placeholder,)).fetchone():
+                    LOGGER.warning('Not caching a stream of %d bytes under %s: it was evicted while being written',
+                                   self.size, self.key)
+                    connection.execute(
+                        'DELETE FROM records WHERE generation = ?', (self.generation,))
+                    return
+                connection.execute(
+                    'DELETE FROM entries WHERE key = ?', (self.placeholder,))
+                self.backend._delete(connection, self.key)
+                now = time.time()
+                connection.execute('INSERT INTO entries (key, size, accessed, created, generation) VALUES (?, ?, ?, ?, ?)',
+                                   (self.key, self.size, now, now, self.generation))
+
+        def abort(self):
+            with self.backend._transaction() as connection:
+                self.backend._delete(connection, self.placeholder)
+
+
+def _is_private(folder):
+    # Owned by the current user, who is the only one with any permission on it
+    try:
+        info = os.stat(folder)
+    except FileNotFoundError:
+        return False
+    return info.st_uid == os.getuid() and not stat.S_IMODE(info.st_mode) & 0o077
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Serialization formats of cache payloads, see :mod:`soweego.commons.cache`.
+
+Each payload starts with a header naming its codec,
+so payloads written with any codec can be read back.
+Payloads with no header are plain JSON, as written before codecs existed.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import json
+import pickle
+import zlib
+from datetime import date, datetime
+from typing import Iterable
+
+# JSON text never starts with a NUL byte
+HEADER_MARKER = b'\0'
+# Fast compression: payloads are decoded far more often than encoded
+COMPRESSION_LEVEL = 1
+# Single-key JSON objects standing for values JSON lacks.
+# The NUL character keeps them apart from regular object keys
+TUPLE_TAG = '\0tuple'
+SET_TAG = '\0set'
+FROZENSET_TAG = '\0frozenset'
+DATE_TAG = '\0date'
+DATETIME_TAG = '\0datetime'
+
+
+class Codec():
+
+    """Interface of cache payload formats"""
+
+    name = None
+    trusted_storage_only = False
+
+    def encode(self, value) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, payload: bytes):
+        raise NotImplementedError
+
+    def encode_items(self, items: list) -> bytes:
+        """Encode a chunk of stream items."""
+        raise NotImplementedError
+
+    def decode_items(self, payload: bytes) -> Iterable:
+        """Decode a chunk of stream items."""
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+
+    """JSON text, with stream items as JSON lines. Tuples come back as lists"""
+
+    name = 'json'
+
+    def encode(self, value):
+        return json.dumps(value).encode('utf8')
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf8'))
+
+    def encode_items(self, items):
+        return b'\n'.join(json.dumps(item).encode('utf8') for item in items)
+
+    def decode_items(self, payload):
+        return [json.loads(line.decode('utf8')) for line in payload.split(b'\n')]
+
+
+class CompressedJSONCodec(Codec):
+
+    """Zlib-compressed JSON, with tuples, sets, dates and datetimes tagged
+    so that they round-trip. Decoding never runs code, whoever wrote the payload
+    """
+
+    name = 'zjson'
+
+    def encode(self, value):
+        return zlib.compress(json.dumps(_tag(value), separators=(',', ':')).encode('utf8'), COMPRESSION_LEVEL)
+
+    def decode(self, payload):
+        return json.loads(zlib.decompress(payload).decode('utf8'), object_hook=_untag)
+
+    def encode_items(self, items):
+        return self.encode(items)
+
+    def decode_items(self, payload):
+        return self.decode(payload)
+
+
+class CompressedPickleCodec(Codec):
+
+    """Zlib-compressed pickles, which round-trip tuples, dates and any other
+    picklable object.
+
+    Loading a pickle can run arbitrary code: the cache only decodes pickles
+    from storages that other users cannot write to.
+    """
+
+    name = 'zpickle'
+    # Decoding a payload may run code chosen by whoever wrote it
+    trusted_storage_only = True
+
+    def encode(self, value):
+        return zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL)
+
+    def decode(self, payload):
+        return pickle.loads(zlib.decompress(payload))
+
+    def encode_items(self, items):
+        return self.encode(items)
+
+    def decode_items(self, payload):
+        return self.decode(payload)
+
+
+CODECS = {codec.name: codec for codec in (
+    JSONCodec(), CompressedJSONCodec(), CompressedPickleCodec())}
+
+
+def get_codec(name) -> Codec:
+    """Return the codec with the given name.
+
+    :raises ValueError: if there is no such codec
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError('Unknown cache codec: "%s". Please pick one of %s' % (
+            name, list(CODECS.keys())))
+    return codec
+
+
+def add_header(codec: Codec, payload: bytes) -> bytes:
+    return HEADER_MARKER + codec.name.encode('ascii') + b'\n' + payload
+
+
+def split_header(payload: bytes) -> tuple:
+    """Return the codec of a payload and the payload without header."""
+    if not payload.startswith(HEADER_MARKER):
+        return CODECS['json'], payload
+    header_end = payload.index(b'\n')
+    return get_codec(payload[1:header_end].decode('ascii')), payload[header_end + 1:]
+
+
+def _tag(value):
+    if isinstance(value, tuple):
+        return {TUPLE_TAG: [_tag(item) for item in value]}
+    if isinstance(value, list):
+        return [_tag(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _tag(item) for key, item in value.items()}
+    if isinstance(value, frozenset):
+        return {FROZENSET_TAG: [_tag(item) for item in value]}
+    if isinstance(value, set):
+        return {SET_TAG: [_tag(item) for item in value]}
+    # Datetimes are dates as well
+    if isinstance(value, datetime):
+        return {DATETIME_TAG: value.isoformat()}
+    if isinstance(value, date):
+        return {DATE_TAG: value.isoformat()}
+    return value
+
+
+_UNTAGGERS = {
+    TUPLE_TAG: tuple,
+    SET_TAG: set,
+    FROZENSET_TAG: frozenset,
+    DATE_TAG: date.fromisoformat,
+    DATETIME_TAG: datetime.fromisoformat
+}
+
+
+def _untag(obj):
+    # Nested objects are already decoded
+    if len(obj) == 1:
+        key, value = next(iter(obj.items()))
+        untagger = _UNTAGGERS.get(key)
+        if untagger is not None:
+            return untagger(value)
+    return obj
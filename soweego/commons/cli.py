@@ -11,7 +11,10 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import click
 
+from soweego.commons import cache
+
 CLI_COMMANDS = {
+    'cache_stats': cache.stats_cli
 }
 
 
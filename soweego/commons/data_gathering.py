@@ -10,23 +10,31 @@ __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import logging
-import re
-from collections import defaultdict
-from typing import Iterable, TypeVar
+from collections import namedtuple
+from typing import Iterable, Sequence, TypeVar
 
-import regex
-from soweego.commons import url_utils
+from soweego.commons import url_utils, utils
 from soweego.commons.cache import cached
 from soweego.commons.constants import HANDLED_ENTITIES, TARGET_CATALOGS
 from soweego.commons.db_manager import DBManager
-from soweego.wikidata import api_requests, sparql_queries, vocabulary
-from sqlalchemy import or_
+from soweego.wikidata import (api_requests, pid_registry, sparql_queries,
+                              vocabulary)
+from sqlalchemy import literal, or_
 
 LOGGER = logging.getLogger(__name__)
 T = TypeVar('T')
 
+# Rows fetched at a time when streaming whole catalog tables
+STREAM_BATCH_SIZE = 10000
+# FULLTEXT queries sent together in a UNION ALL statement
+FULLTEXT_BATCH_SIZE = 100
+# name = ? queries sent together in a UNION ALL statement
+PERFECT_MATCH_BATCH_SIZE = 500
+# Label of the column telling which query of a batch yields a row
+QUERY_TAG = 'tagged_query'
 
-@cached
+
+@cached(catalog_arg='catalog')
 def gather_target_metadata(entity_type, catalog):
     catalog_constants = _get_catalog_constants(catalog)
     catalog_entity = _get_catalog_entity(entity_type, catalog_constants)
@@ -37,24 +45,20 @@ def gather_target_metadata(entity_type, catalog):
     # Base metadata
     query_fields = _build_metadata_query_fields(entity, entity_type, catalog)
 
-    session = DBManager.connect_to_db()
-    result = None
-    try:
-        result = _run_metadata_query(
-            session, query_fields, entity, catalog, entity_type)
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-
-    if not result:
+    if not _has_rows(_metadata_query, query_fields, entity):
+        LOGGER.warning(
+            "No metadata available for %s %s. Stopping validation here", catalog, entity_type)
         return None
-    return _parse_target_metadata_query_result(result)
+    # Lazy: the query only runs when the caller starts consuming the result
+    return _parse_target_metadata_query_result(
+        _run_metadata_query(query_fields, entity, catalog, entity_type))
 
 
-def tokens_fulltext_search(target_entity: T, boolean_mode: bool, tokens: Iterable[str]) -> Iterable[T]:
+def tokens_fulltext_search(target_entity: T, boolean_mode: bool, tokens: Iterable[str], columns: Sequence[str] = None) -> Iterable[T]:
+    """Run a FULLTEXT query against the ``tokens`` column of the given table.
+
+    If ``columns`` is given, only fetch them, see :func:`project`.
+    """
     query = None
     if boolean_mode:
         query = ' '.join(map('+{0}'.format, tokens))
@@ -63,61 +67,200 @@ def tokens_fulltext_search(target_entity: T, boolean_mode: bool, tokens: Iterabl
 
     ft_search = target_entity.tokens.match(query)
 
-    session = DBManager.connect_to_db()
-    result = []
-    try:
-        result = session.query(target_entity).filter(ft_search).all()
-        session.commit()
-    except:
-        session.rollback()
-        raise
+    with DBManager.session_scope() as session:
+        result = session.query(
+            *project(target_entity, columns)).filter(ft_search).all()
 
     if not result:
         return []
     return result
 
 
-def name_fulltext_search(target_entity: T, query: str) -> Iterable[T]:
+def name_fulltext_search(target_entity: T, query: str, columns: Sequence[str] = None) -> Iterable[T]:
+    """Run a FULLTEXT query against the ``name`` column of the given table.
+
+    If ``columns`` is given, only fetch them, see :func:`project`.
+    """
     ft_search = target_entity.name.match(query)
 
-    session = DBManager.connect_to_db()
-    try:
-        for r in session.query(target_entity).filter(ft_search).all():
+    with DBManager.session_scope() as session:
+        for r in session.query(*project(target_entity, columns)).filter(ft_search).all():
             yield r
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-
-
-def perfect_name_search(target_entity: T, to_search: str) -> Iterable[T]:
-    session = DBManager.connect_to_db()
-    try:
-        for r in session.query(target_entity).filter(
+
+
+def tokens_fulltext_search_many(target_entity: T, boolean_mode: bool, keyed_tokens: Iterable[tuple], columns: Sequence[str] = None) -> dict:
+    """Batch variant of :func:`tokens_fulltext_search`.
+
+    Run a FULLTEXT query for each ``(key, tokens)`` pair, sending
+    ``FULLTEXT_BATCH_SIZE`` queries per round trip as a single ``UNION ALL`` statement.
+
+    :return: ``{key: [results]}`` with all the given keys
+    :rtype: dict
+    """
+    def build_query(tokens):
+        tokens = list(tokens)
+        if boolean_mode:
+            return ' '.join(map('+{0}'.format, tokens))
+        return ' '.join(tokens)
+
+    return _fulltext_search_many(target_entity, target_entity.tokens,
+                                 ((key, build_query(tokens)) for key, tokens in keyed_tokens), columns)
+
+
+def name_fulltext_search_many(target_entity: T, keyed_queries: Iterable[tuple], columns: Sequence[str] = None) -> dict:
+    """Batch variant of :func:`name_fulltext_search`.
+
+    Run a FULLTEXT query for each ``(key, query)`` pair, sending
+    ``FULLTEXT_BATCH_SIZE`` queries per round trip as a single ``UNION ALL`` statement.
+
+    :return: ``{key: [results]}`` with all the given keys
+    :rtype: dict
+    """
+    return _fulltext_search_many(target_entity, target_entity.name, keyed_queries, columns)
+
+
+def _fulltext_search_many(target_entity, column, keyed_queries, columns):
+    return _search_many(target_entity, ((key, column.match(query) if query else None) for key, query in keyed_queries),
+                        columns, FULLTEXT_BATCH_SIZE)
+
+
+def _search_many(target_entity, keyed_conditions, columns, batch_size):
+    # Keys with no condition get no results
+    results = {}
+    for bucket in utils.stream_buckets(keyed_conditions, batch_size):
+        keys = []
+        conditions = []
+        for key, condition in bucket:
+            results[key] = []
+            if condition is None:
+                continue
+            # Each query is tagged with the position of its key
+            conditions.append((len(keys), condition))
+            keys.append(key)
+        if not conditions:
+            continue
+        with DBManager.session_scope() as session:
+            for tag, row in _tagged_search(session, target_entity, conditions, columns):
+                results[keys[tag]].append(row)
+    return results
+
+
+def _tagged_search(session, target_entity, tagged_conditions, columns):
+    # A single UNION ALL statement with one query per condition,
+    # yielding (tag, row) pairs
+    row_type = namedtuple('TaggedResult', columns) if columns else None
+    subqueries = [session.query(literal(tag).label(QUERY_TAG), *project(target_entity, columns)).filter(condition)
+                  for tag, condition in tagged_conditions]
+    statement = subqueries[0].union_all(
+        *subqueries[1:]) if len(subqueries) > 1 else subqueries[0]
+    for row in statement.all():
+        yield row[0], row_type(*row[1:]) if columns else row[1]
+
+
+def perfect_name_search(target_entity: T, to_search: str, columns: Sequence[str] = None) -> Iterable[T]:
+    """Look up the given string in the ``name`` column of the given table.
+
+    If ``columns`` is given, only fetch them, see :func:`project`.
+    """
+    with DBManager.session_scope() as session:
+        for r in session.query(*project(target_entity, columns)).filter(
                 target_entity.name == to_search).all():
             yield r
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-
-
-def _run_metadata_query(session, query_fields, entity, catalog, entity_type):
-    query = session.query(
-        *query_fields).filter(or_(entity.born.isnot(None), entity.died.isnot(None)))
-    count = query.count()
-    if count == 0:
-        LOGGER.warning(
-            "No metadata available for %s %s. Stopping validation here", catalog, entity_type)
-        return None
+
+
+def perfect_name_search_many(target_entity: T, keyed_names: Iterable[tuple], columns: Sequence[str] = None) -> dict:
+    """Batch variant of :func:`perfect_name_search`.
+
+    Run a ``name = ?`` query for each ``(key, name)`` pair, sending
+    ``PERFECT_MATCH_BATCH_SIZE`` queries per round trip as a single ``UNION ALL`` statement.
+    Rows are tagged with the query yielding them, so the database collation
+    decides which name they match.
+
+    :return: ``{key: [results]}`` with all the given keys
+    :rtype: dict
+    """
+    return _search_many(target_entity, ((key, target_entity.name == name) for key, name in keyed_names),
+                        columns, PERFECT_MATCH_BATCH_SIZE)
+
+
+def candidates_search(target_entity: T, keyed_names: Sequence[tuple], tokens: Iterable[str]) -> tuple:
+    """Fetch the ``catalog_id``, ``name`` and ``tokens`` columns of rows
+    having one of the given names or at least one of the given tokens,
+    in a single ``UNION ALL`` statement.
+
+    :param keyed_names: ``(key, name)`` pairs with distinct keys
+    :return: ``{key: [rows with the key name]}`` as in :func:`perfect_name_search_many`,
+     and the list of all the fetched rows
+    :rtype: tuple
+    """
+    columns = ('catalog_id', 'name', 'tokens')
+    condition = target_entity.name.in_([name for _, name in keyed_names])
+    query = ' '.join(tokens)
+    if query:
+        condition = or_(condition, target_entity.tokens.match(query))
+    # One query per name, tagged with its position, plus the whole candidate set
+    all_tag = len(keyed_names)
+    tagged_conditions = [(tag, target_entity.name == name)
+                         for tag, (_, name) in enumerate(keyed_names)]
+    tagged_conditions.append((all_tag, condition))
+
+    perfect = {key: [] for key, _ in keyed_names}
+    candidates = []
+    with DBManager.session_scope() as session:
+        for tag, row in _tagged_search(session, target_entity, tagged_conditions, columns):
+            if tag == all_tag:
+                candidates.append(row)
+            else:
+                perfect[keyed_names[tag][0]].append(row)
+    return perfect, candidates
+
+
+def project(target_entity: T, columns: Sequence[str] = None) -> list:
+    """Return the query entities that fetch the given columns of a table.
+
+    With no ``columns``, whole ORM objects of ``target_entity`` are built.
+    Otherwise, each result is a lightweight named tuple holding only
+    the given columns, skipping the ORM object hydration and identity map.
+
+    :raises AttributeError: if ``target_entity`` has no such column
+    """
+    if not columns:
+        return [target_entity]
+    return [getattr(target_entity, column) for column in columns]
+
+
+def gather_target_tokens(target_entity: T) -> Iterable[tuple]:
+    """Yield ``(catalog_id, tokens)`` pairs of the whole given table."""
+    with DBManager.session_scope() as session:
+        for r in _stream(session.query(target_entity.catalog_id, target_entity.tokens)):
+            yield r.catalog_id, r.tokens
+
+
+def _metadata_query(session, query_fields, entity):
+    return session.query(*query_fields).filter(or_(entity.born.isnot(None), entity.died.isnot(None)))
+
+
+def _run_metadata_query(query_fields, entity, catalog, entity_type):
+    with DBManager.session_scope() as session:
+        query = _metadata_query(session, query_fields, entity)
+        count = 0
+        for row in _stream(query):
+            count += 1
+            yield row
     LOGGER.info('Got %d entries with metadata from %s %s',
                 count, catalog, entity_type)
-    result_set = query.all()
-    return result_set
+
+
+def _has_rows(build_query, *args) -> bool:
+    # A cheap EXISTS query: unlike peeking at a stream, it leaves
+    # no server-side cursor open while the caller does other work
+    with DBManager.session_scope() as session:
+        return session.query(build_query(session, *args).exists()).scalar()
+
+
+def _stream(query):
+    # Server-side cursor: rows are fetched in batches as they are consumed
+    return query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
 
 
 def _build_metadata_query_fields(entity, entity_type, catalog):
@@ -174,7 +317,7 @@ def _parse_target_metadata_query_result(result_set):
             LOGGER.debug('%s: no death place available', identifier)
 
 
-@cached
+@cached(catalog_arg='catalog')
 def gather_target_links(entity_type, catalog):
     catalog_constants = _get_catalog_constants(catalog)
     catalog_entity = _get_catalog_entity(entity_type, catalog_constants)
@@ -182,28 +325,26 @@ def gather_target_links(entity_type, catalog):
     LOGGER.info('Gathering %s %s links ...', catalog, entity_type)
     link_entity = catalog_entity['link_entity']
 
-    session = DBManager.connect_to_db()
-    result = None
-    try:
-        query = session.query(link_entity.catalog_id, link_entity.url)
-        count = query.count()
-        if count == 0:
-            LOGGER.warning(
-                "No links available for %s %s. Stopping validation here", catalog, entity_type)
-            return None
-        LOGGER.info('Got %d links from %s %s', count, catalog, entity_type)
-        result = query.all()
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-
-    if result is None:
+    if not _has_rows(_links_query, link_entity):
+        LOGGER.warning(
+            "No links available for %s %s. Stopping validation here", catalog, entity_type)
         return None
-    for row in result:
-        yield row.catalog_id, row.url
+    # Lazy: the query only runs when the caller starts consuming the result
+    return _run_links_query(link_entity, catalog, entity_type)
+
+
+def _links_query(session, link_entity):
+    return session.query(link_entity.catalog_id, link_entity.url)
+
+
+def _run_links_query(link_entity, catalog, entity_type):
+    with DBManager.session_scope() as session:
+        query = _links_query(session, link_entity)
+        count = 0
+        for row in _stream(query):
+            count += 1
+            yield row.catalog_id, row.url
+    LOGGER.info('Got %d links from %s %s', count, catalog, entity_type)
 
 
 def _get_catalog_entity(entity, catalog_constants):
@@ -264,24 +405,10 @@ def gather_wikidata_links(wikidata, url_pids, ext_id_pids_to_urls):
 
 
 def gather_relevant_pids():
-    url_pids = set()
-    for result in sparql_queries.url_pids_query():
-        url_pids.add(result)
-    ext_id_pids_to_urls = defaultdict(dict)
-    for result in sparql_queries.external_id_pids_and_urls_query():
-        for pid, formatters in result.items():
-            for formatter_url, formatter_regex in formatters.items():
-                if formatter_regex:
-                    try:
-                        compiled_regex = re.compile(formatter_regex)
-                    except re.error:
-                        LOGGER.debug(
-                            "Using 'regex' third-party library. Formatter regex not supported by the 're' standard library: %s", formatter_regex)
-                        compiled_regex = regex.compile(formatter_regex)
-                else:
-                    compiled_regex = None
-                ext_id_pids_to_urls[pid][formatter_url] = compiled_regex
-    return url_pids, ext_id_pids_to_urls
+    """Return the set of PIDs with URL values and the formatter URLs
+    of external identifier PIDs, see :mod:`soweego.wikidata.pid_registry`.
+    """
+    return pid_registry.load()
 
 
 def gather_identifiers(entity, catalog, catalog_pid, aggregated):
@@ -298,12 +425,13 @@ def gather_identifiers(entity, catalog, catalog_pid, aggregated):
 
 def extract_ids_from_urls(to_add, ext_id_pids_to_urls):
     LOGGER.info('Starting extraction of IDs from target links to be added ...')
+    if not isinstance(ext_id_pids_to_urls, url_utils.FormatterIndex):
+        ext_id_pids_to_urls = url_utils.FormatterIndex(ext_id_pids_to_urls)
     ext_ids_to_add = []
     urls_to_add = []
     for qid, urls in to_add.items():
         for url in urls:
-            ext_id, pid = url_utils.get_external_id_from_url(
-                url, ext_id_pids_to_urls)
+            ext_id, pid = ext_id_pids_to_urls.extract(url)
             if ext_id:
                 ext_ids_to_add.append((qid, pid, ext_id))
             else:
@@ -11,43 +11,52 @@ __copyright__ = 'Copyleft 2018, lenzi.edoardo'
 
 import json
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 from pkgutil import get_data
 
 from soweego.commons import constants as const
 from soweego.commons import localizations as loc
 from soweego.importer.models.musicbrainz_entity import MusicbrainzArtistEntity
-from sqlalchemy import Index, create_engine, text
+from sqlalchemy import Index, create_engine, event, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import configure_mappers, sessionmaker
-from sqlalchemy.pool import NullPool
 
 BASE = declarative_base()
 LOGGER = logging.getLogger(__name__)
 
+# Connections each process may hold
+POOL_SIZE = 4
+# Seconds to wait for a free connection when all of them are in use
+POOL_TIMEOUT = 60
+# Seconds after which unused connections are closed.
+# Wikimedia policy forbids holding idle connections, see
+# https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#Connection_handling_policy
+IDLE_TIMEOUT = 30
+
+_engine = None
+_engine_pid = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
 
-# TODO this class should become a singleton
 class DBManager():
 
-    """Exposes some primitives for the DB access"""
+    """Exposes some primitives for the DB access.
+
+    All the instances of a process share the same engine,
+    which holds at most ``POOL_SIZE`` connections
+    and closes them after ``IDLE_TIMEOUT`` seconds of inactivity.
+    """
 
     __engine: object
 
     def __init__(self):
-        credentials = json.loads(
-            get_data('soweego.importer.resources', 'db_credentials.json'))
-        db_engine = credentials[const.DB_ENGINE_KEY]
-        db_name = credentials[const.PROD_DB_KEY]
-        user = credentials[const.USER_KEY]
-        password = credentials[const.PASSWORD_KEY]
-        host = credentials[const.HOST_KEY]
-        try:
-            # Disable connection pooling, as per Wikimedia policy
-            # https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#Connection_handling_policy
-            self.__engine = create_engine(
-                '{0}://{1}:{2}@{3}/{4}'.format(db_engine, user, password, host, db_name), poolclass=NullPool)
-        except Exception as error:
-            LOGGER.critical(loc.FAIL_CREATE_ENGINE, error)
+        self.__engine = _get_engine()
 
     def get_engine(self) -> Engine:
         """Return the current SQL Alchemy engine instance"""
@@ -55,8 +64,7 @@ class DBManager():
 
     def new_session(self) -> object:
         """Create a new DB session"""
-        Session = sessionmaker(bind=self.__engine)
-        return Session()
+        return _session_factory()
 
     def create(self, tables) -> None:
         """Create the tables (tables can be ORM entity instances or classes)"""
@@ -74,3 +82,78 @@ class DBManager():
         db_manager = DBManager()
         session = db_manager.new_session()
         return session
+
+    @staticmethod
+    @contextmanager
+    def session_scope():
+        """Provide a session that is committed if the block succeeds,
+        rolled back otherwise, and closed in any case,
+        giving its connection back to the pool.
+        """
+        session = DBManager.connect_to_db()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+@lru_cache(maxsize=1)
+def _database_url():
+    credentials = json.loads(
+        get_data('soweego.importer.resources', 'db_credentials.json'))
+    db_engine = credentials[const.DB_ENGINE_KEY]
+    db_name = credentials[const.PROD_DB_KEY]
+    user = credentials[const.USER_KEY]
+    password = credentials[const.PASSWORD_KEY]
+    host = credentials[const.HOST_KEY]
+    return '{0}://{1}:{2}@{3}/{4}'.format(db_engine, user, password, host, db_name)
+
+
+def _get_engine():
+    global _engine, _engine_pid, _session_factory
+    with _engine_lock:
+        # Pooled connections must not cross a fork:
+        # child processes build their own engine
+        if _engine is None or _engine_pid != os.getpid():
+            try:
+                _engine = create_engine(_database_url(), pool_size=POOL_SIZE, max_overflow=0,
+                                        pool_timeout=POOL_TIMEOUT)
+            except Exception as error:
+                LOGGER.critical(loc.FAIL_CREATE_ENGINE, error)
+                return None
+            _engine_pid = os.getpid()
+            _session_factory = sessionmaker(bind=_engine)
+            _IdleReaper(_engine).start()
+        return _engine
+
+
+class _IdleReaper(threading.Thread):
+
+    """Close the pooled connections of an engine when none of them
+    has been in use for ``IDLE_TIMEOUT`` seconds
+    """
+
+    def __init__(self, engine):
+        super().__init__(name='idle-connection-reaper', daemon=True)
+        self.engine = engine
+        self.last_used = time.monotonic()
+        # Listeners survive the pool re-creation done by Engine.dispose
+        event.listen(engine, 'checkout', self._touch)
+        event.listen(engine, 'checkin', self._touch)
+
+    def _touch(self, *_):
+        self.last_used = time.monotonic()
+
+    def run(self):
+        while self.engine is _engine:
+            time.sleep(IDLE_TIMEOUT / 2)
+            pool = self.engine.pool
+            idle = time.monotonic() - self.last_used
+            if pool.checkedin() and not pool.checkedout() and idle >= IDLE_TIMEOUT:
+                LOGGER.debug(
+                    'Closing %d database connections idle for %.0f seconds', pool.checkedin(), idle)
+                self.engine.dispose()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Deletion-neighbourhood index of target names, a la SymSpell:
+https://github.com/wolfgarbe/SymSpell
+
+Two strings within edit distance ``k`` always share a variant obtained
+by deleting at most ``k`` characters from each of them.
+This holds for the first ``prefix_length`` characters as well,
+so only name prefixes are expanded, keeping the index small.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import logging
+import os
+import pickle
+from array import array
+from collections import namedtuple
+from datetime import datetime
+
+import numpy
+from soweego.commons import similarity, text_utils
+from soweego.commons.db_manager import DBManager
+
+LOGGER = logging.getLogger(__name__)
+
+# Maximum edit distance supported by an index
+MAX_DISTANCE = 2
+# Amount of leading characters expanded into deletion variants
+PREFIX_LENGTH = 7
+INDEX_FILE_NAME = '%s_deletion_index.pkl'
+# Target rows fetched at a time while building an index
+STREAM_BATCH_SIZE = 10000
+DISTANCES = {
+    'l': similarity.levenshtein,
+    'dl': similarity.damerau_levenshtein
+}
+
+Candidate = namedtuple('Candidate', ['catalog_id', 'name'])
+
+
+class DeletionIndex():
+
+    """Map deletion variants of normalized name prefixes to target names."""
+
+    def __init__(self, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        # Deletion variant -> prefix identifiers
+        self._variants = {}
+        # Prefix identifier -> candidate identifiers
+        self._prefix_candidates = []
+        self._candidates = []
+        self._normalized = []
+
+    def __len__(self):
+        return len(self._candidates)
+
+    @classmethod
+    def build(cls, target_entity, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH) -> 'DeletionIndex':
+        """Build the index from the ``name`` column of the given ``BaseEntity`` table."""
+        LOGGER.info('Building the deletion index of %s with max distance %d and prefix length %d ...',
+                    target_entity.__tablename__, max_distance, prefix_length)
+        start = datetime.now()
+        with DBManager.session_scope() as session:
+            # Server-side cursor: rows are fetched in batches as the index consumes them
+            rows = session.query(target_entity.catalog_id, target_entity.name).execution_options(
+                stream_results=True).yield_per(STREAM_BATCH_SIZE)
+            index = cls.from_rows(rows, max_distance, prefix_length)
+        LOGGER.info('Deletion index of %s built in %s: %d names, %d prefixes, %d deletion variants',
+                    target_entity.__tablename__, datetime.now() - start, len(index), len(index._prefix_candidates), len(index._variants))
+        return index
+
+    @classmethod
+    def from_rows(cls, rows, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH) -> 'DeletionIndex':
+        """Build the index from ``(catalog_id, name)`` pairs."""
+        index = cls(max_distance, prefix_length)
+        prefix_ids = {}
+        for catalog_id, name in rows:
+            if not name:
+                continue
+            _, normalized = text_utils.normalize(name)
+            prefix = normalized[:prefix_length]
+            prefix_id = prefix_ids.get(prefix)
+            if prefix_id is None:
+                prefix_id = len(index._prefix_candidates)
+                prefix_ids[prefix] = prefix_id
+                index._prefix_candidates.append(array('I'))
+                for variant in _deletion_variants(prefix, max_distance):
+                    index._variants.setdefault(
+                        variant, array('I')).append(prefix_id)
+            index._prefix_candidates[prefix_id].append(len(index._candidates))
+            index._candidates.append(Candidate(catalog_id, name))
+            index._normalized.append(normalized)
+        return index
+
+    @classmethod
+    def load(cls, file_path: str) -> 'DeletionIndex':
+        with open(file_path, 'rb') as index_file:
+            index = pickle.load(index_file)
+        LOGGER.info("Loaded deletion index of %d names from '%s'",
+                    len(index), file_path)
+        return index
+
+    def dump(self, file_path: str) -> None:
+        with open(file_path, 'wb') as index_file:
+            pickle.dump(self, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        LOGGER.info("Deletion index dumped to '%s'", file_path)
+
+    def supports(self, metric: str, threshold) -> bool:
+        """Whether the index can serve the given edit distance ``metric`` and ``threshold``."""
+        return metric in DISTANCES and 0 <= threshold <= self.max_distance
+
+    def lookup(self, string: str, metric: str, threshold) -> list:
+        """Return the candidates whose normalized name is within
+        edit distance ``threshold`` from the normalized ``string``.
+
+        :param metric: ``l`` (Levenshtein) or ``dl`` (Damerau-Levenshtein)
+        :raises ValueError: if the index does not support the given metric and threshold
+        """
+        if not self.supports(metric, threshold):
+            raise ValueError('Deletion index with max distance %d cannot serve %s distance <= %s' % (
+                self.max_distance, metric, threshold))
+        distance_function = DISTANCES[metric]
+        max_distance = int(threshold)
+        _, normalized = text_utils.normalize(string)
+        prefix_ids = set()
+        for variant in _deletion_variants(normalized[:self.prefix_length], max_distance):
+            prefix_ids.update(self._variants.get(variant, ()))
+        candidate_ids = [candidate_id for prefix_id in prefix_ids
+                         for candidate_id in self._prefix_candidates[prefix_id]]
+        distances = distance_function(
+            normalized, [self._normalized[candidate_id] for candidate_id in candidate_ids], max_distance)
+        return [self._candidates[candidate_ids[i]] for i in numpy.flatnonzero(distances <= max_distance)]
+
+
+def index_path(folder: str, target_entity) -> str:
+    """Where the deletion index of the given ``BaseEntity`` table lives."""
+    return os.path.join(folder, INDEX_FILE_NAME % target_entity.__tablename__)
+
+
+def _deletion_variants(string, max_deletions):
+    variants = {string}
+    frontier = {string}
+    for _ in range(max_deletions):
+        frontier = {variant[:i] + variant[i + 1:]
+                    for variant in frontier for i in range(len(variant))}
+        variants.update(frontier)
+    return variants
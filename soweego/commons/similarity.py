@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Batch string similarity scoring of one source string against many target candidates.
+
+Candidates are expected to be already normalized, see :func:`soweego.commons.text_utils.normalize`.
+Each scorer returns a NumPy array of scores aligned with the candidates,
+where ``nan`` marks pairs that were skipped since they cannot pass the threshold.
+
+Skipping relies on length prefilters only: a bound computed from the string lengths
+of all the candidates at once, in NumPy. The remaining pairs are fully scored by jellyfish.
+There is no early exit from the dynamic programming itself, e.g., a banded Levenshtein:
+jellyfish runs it in C, and a pure Python banded version is slower on names of
+a few dozen characters, even when it stops early.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import logging
+from typing import Sequence
+
+import jellyfish
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+# Jaro-Winkler boosts the Jaro similarity by 0.1 for each
+# of the first 4 characters in common
+JW_MAX_PREFIX_BOOST = 0.4
+
+
+def levenshtein(source: str, candidates: Sequence[str], threshold=None) -> numpy.ndarray:
+    """Levenshtein distances.
+    Pairs whose length difference alone exceeds ``threshold`` are skipped.
+    """
+    return _length_prefiltered_distances(jellyfish.levenshtein_distance, source, candidates, threshold)
+
+
+def damerau_levenshtein(source: str, candidates: Sequence[str], threshold=None) -> numpy.ndarray:
+    """Damerau-Levenshtein distances.
+    Pairs whose length difference alone exceeds ``threshold`` are skipped.
+    """
+    return _length_prefiltered_distances(jellyfish.damerau_levenshtein_distance, source, candidates, threshold)
+
+
+def jaro_winkler(source: str, candidates: Sequence[str], threshold=None) -> numpy.ndarray:
+    """Jaro-Winkler similarities.
+    Pairs whose lengths alone bound the similarity below ``threshold`` are skipped.
+    """
+    lengths = _lengths(candidates)
+    to_score = numpy.ones(len(lengths), dtype=bool)
+    if threshold is not None and len(source) and len(lengths):
+        # At most all the characters of the shortest string are in common,
+        # with no transpositions and the highest prefix boost
+        common = numpy.minimum(lengths, len(source))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            jaro_bound = (common / len(source) + common / lengths + 1) / 3
+        upper_bound = jaro_bound + JW_MAX_PREFIX_BOOST * (1 - jaro_bound)
+        upper_bound[lengths == 0] = 0
+        to_score = upper_bound >= threshold
+    return _score(jellyfish.jaro_winkler, source, candidates, to_score)
+
+
+def _length_prefiltered_distances(distance_function, source, candidates, threshold):
+    lengths = _lengths(candidates)
+    if threshold is None:
+        to_score = numpy.ones(len(lengths), dtype=bool)
+    else:
+        # The length difference is a lower bound of both distances
+        to_score = numpy.abs(lengths - len(source)) <= threshold
+    return _score(distance_function, source, candidates, to_score)
+
+
+def _lengths(candidates):
+    return numpy.fromiter(map(len, candidates), dtype=numpy.int64, count=len(candidates))
+
+
+def _score(scoring_function, source, candidates, to_score):
+    scores = numpy.full(len(to_score), numpy.nan)
+    # Name variations often repeat the same string
+    already_scored = {}
+    for i in numpy.flatnonzero(to_score):
+        candidate = candidates[i]
+        score = already_scored.get(candidate)
+        if score is None:
+            try:
+                score = scoring_function(source, candidate)
+            # Damerau-Levenshtein does not support some Unicode code points
+            except ValueError:
+                LOGGER.warning(
+                    'Skipping unsupported string in pair: "%s", "%s"', source, candidate)
+                score = numpy.nan
+            already_scored[candidate] = score
+        scores[i] = score
+    LOGGER.debug('%s: scored %d out of %d candidates of "%s"',
+                 scoring_function.__name__, len(already_scored), len(scores), source)
+    return scores
@@ -11,10 +11,16 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import logging
 import re
+from functools import lru_cache
 from pkgutil import get_data
+from typing import Iterable, List
 
 LOGGER = logging.getLogger(__name__)
 
+TOKEN_SPLITTER = re.compile(r'\W+')
+# Amount of distinct texts remembered by the batch functions
+MEMO_SIZE = 2 ** 17
+
 # Adapted from http://snowball.tartarus.org/algorithms/english/stop.txt
 STOPWORDS_ENG = frozenset(str(get_data(
     'soweego.commons.resources', 'stopwords_eng.txt'), 'utf8').splitlines())
@@ -71,18 +77,41 @@ ASCII_TRANSLATION_TABLE = str.maketrans({
 
 def tokenize(text, stopwords=STOPWORDS_ENG):
     """:func:`Normalize` and tokenize a text."""
-    tokens = set()
     ascii_only, ascii_lowercase = normalize(text)
-    split = re.split(r'\W+', ascii_lowercase)
-    filtered = filter(lambda token: len(token) > 1, split)
-    for token in filtered:
-        if token and token not in stopwords:
-            tokens.add(token)
-    LOGGER.debug('Tokenization pipeline: INPUT --> %s --> ASCII --> %s --> LOWERCASE --> %s --> SPLIT --> %s --> NO 0/1-GRAMS + NO STOPWORDS --> %s',
-                 text, ascii_only, ascii_lowercase, split, tokens)
+    split = TOKEN_SPLITTER.split(ascii_lowercase)
+    tokens = {token for token in split
+              if len(token) > 1 and token not in stopwords}
+    # Building the message is expensive
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('Tokenization pipeline: INPUT --> %s --> ASCII --> %s --> LOWERCASE --> %s --> SPLIT --> %s --> NO 0/1-GRAMS + NO STOPWORDS --> %s',
+                     text, ascii_only, ascii_lowercase, split, tokens)
     return tokens
 
 
+def tokenize_many(texts: Iterable[str], stopwords=STOPWORDS_ENG) -> List[frozenset]:
+    """:func:`Tokenize` a batch of texts.
+
+    Results of the last ``MEMO_SIZE`` distinct texts are remembered,
+    so repeated names are tokenized once. They are shared, hence immutable.
+    """
+    return [_tokenize_memo(text, stopwords) for text in texts]
+
+
+def normalize_many(texts: Iterable[str]) -> List[tuple]:
+    """:func:`Normalize` a batch of texts, remembering the last ``MEMO_SIZE`` distinct ones."""
+    return [_normalize_memo(text) for text in texts]
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _tokenize_memo(text, stopwords):
+    return frozenset(tokenize(text, stopwords))
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _normalize_memo(text):
+    return normalize(text)
+
+
 def normalize(text):
     """Strip, convert to ASCII and lowercase a text."""
     ascii_only = text.strip().translate(ASCII_TRANSLATION_TABLE)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Persistent store of URL resolutions, shared across imports.
+
+Each URL is stored with its resolved URL, or ``None`` if it is dead,
+the HTTP status of the last check, if any, and the check time.
+Resolutions older than the re-check interval are treated as missing,
+so only new or expired URLs hit the network.
+Timeouts and connection errors are not stored: those URLs are checked again next time.
+Hosts found unreachable are stored as well, but expire after hours:
+they are often just down for a while.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable
+
+from soweego.commons import cache, utils
+
+LOGGER = logging.getLogger(__name__)
+
+STORE_FILE_NAME = 'url_resolutions.sqlite3'
+# In the folder shared across runs, like the cache. The importer stores it in its output folder
+STORE_PATH = os.path.join(cache.SHARED_DIR, STORE_FILE_NAME)
+# Resolutions older than this are checked again
+RECHECK_INTERVAL_DAYS = 30
+# Dead hosts older than this are given another chance
+DEAD_HOST_TTL_HOURS = 6
+# Seconds to wait for another process holding the write lock
+LOCK_TIMEOUT = 60
+# SQLite allows at most 999 query parameters
+LOOKUP_BATCH_SIZE = 500
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resolutions (
+    url TEXT PRIMARY KEY,
+    resolved TEXT,
+    status INTEGER,
+    checked REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_hosts (
+    host TEXT PRIMARY KEY,
+    checked REAL NOT NULL
+)
+'''
+
+_store = None
+
+
+class URLStore():
+
+    """URL resolutions in a single SQLite file.
+
+    Each thread of each process gets its own connection,
+    and each write is a transaction, so the file can be shared.
+    """
+
+    def __init__(self, path, recheck_interval_days=RECHECK_INTERVAL_DAYS, dead_host_ttl_hours=DEAD_HOST_TTL_HOURS):
+        self.path = path
+        self.recheck_interval = recheck_interval_days * 24 * 3600
+        self.dead_host_ttl = dead_host_ttl_hours * 3600
+        self._local = threading.local()
+
+    def lookup(self, urls: Iterable[str]) -> dict:
+        """Return ``{url: (resolved, status)}`` for the given URLs
+        checked within the re-check interval.
+        """
+        oldest = time.time() - self.recheck_interval
+        connection = self._connect()
+        known = {}
+        for bucket in utils.stream_buckets(urls, LOOKUP_BATCH_SIZE):
+            query = 'SELECT url, resolved, status FROM resolutions WHERE checked >= ? AND url IN (%s)' % ', '.join(
+                '?' * len(bucket))
+            for url, resolved, status in connection.execute(query, [oldest] + bucket):
+                known[url] = (resolved, status)
+        return known
+
+    def record(self, resolutions: Iterable[tuple]):
+        """Store ``(url, resolved, status)`` triples, checked now."""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany('INSERT OR REPLACE INTO resolutions (url, resolved, status, checked) VALUES (?, ?, ?, ?)',
+                                   ((url, resolved, status, now) for url, resolved, status in resolutions))
+
+    def dead_hosts(self) -> set:
+        """Return the hosts found unreachable within the dead host time to live."""
+        oldest = time.time() - self.dead_host_ttl
+        return {host for host, in self._connect().execute(
+            'SELECT host FROM dead_hosts WHERE checked >= ?', (oldest,))}
+
+    def add_dead_host(self, host):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO dead_hosts (host, checked) VALUES (?, ?)',
+                               (host, time.time()))
+
+    def remove_dead_host(self, host):
+        with self._transaction() as connection:
+            connection.execute(
+                'DELETE FROM dead_hosts WHERE host = ?', (host,))
+
+    def usage(self) -> tuple:
+        """Return the amount of stored resolutions and of dead URLs among them."""
+        return tuple(self._connect().execute(
+            'SELECT COUNT(*), COUNT(*) - COUNT(resolved) FROM resolutions').fetchone())
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def _connect(self):
+        # SQLite connections must not cross a fork nor a thread
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, mode=0o700, exist_ok=True)
+            local.connection = sqlite3.connect(
+                self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA.split(';'):
+                local.connection.execute(statement)
+            local.pid = os.getpid()
+        return local.connection
+
+
+def get_store() -> URLStore:
+    """Return the current URL store.
+    Unless set via :func:`set_store`, a :class:`URLStore`
+    in ``STORE_PATH`` with a re-check interval of ``RECHECK_INTERVAL_DAYS``
+    and a dead host time to live of ``DEAD_HOST_TTL_HOURS``.
+    """
+    global _store
+    if _store is None:
+        _store = URLStore(STORE_PATH, RECHECK_INTERVAL_DAYS,
+                          DEAD_HOST_TTL_HOURS)
+    return _store
+
+
+def set_store(store: URLStore):
+    """Replace the URL store, e.g., to change the re-check interval"""
+    global _store
+    _store = store
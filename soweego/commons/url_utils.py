@@ -11,19 +11,36 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import logging
 import re
-from functools import lru_cache
+import threading
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Iterable, Iterator
 from urllib.parse import urlsplit
 
 import regex
 import requests.exceptions
 from requests import get
+from soweego.commons import url_store
 from urllib3 import disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 
 LOGGER = logging.getLogger(__name__)
 
+_breaker = None
+
 # HTTP requests timeout in seconds
 READ_TIMEOUT = 10
+# Concurrent URL resolution: total requests in flight,
+# requests in flight to the same host, URLs waiting for a free slot
+RESOLVE_WORKERS = 64
+RESOLVE_PER_HOST = 4
+RESOLVE_BUFFER_SIZE = 10000
+# Resolutions read from and written to the URL store together
+STORE_BATCH_SIZE = 500
+# Consecutive timeouts or connection errors that make a host dead
+MAX_HOST_FAILURES = 5
 
 # URLs stopwords
 TOP_LEVEL_DOMAINS = set(['com', 'org', 'net', 'info', 'fm'])
@@ -46,6 +63,90 @@ WIKI_PROJECTS = [
 ]
 
 
+class HostBreaker():
+
+    """Per-host circuit breaker.
+
+    After ``max_failures`` consecutive timeouts or connection errors,
+    a host is dead for the rest of the run: its URLs are dropped
+    without waiting for the network.
+
+    Hosts found dead by previous runs are only suspected:
+    the next request to each one is a probe. A single failure
+    makes it dead again, a success clears it.
+    If a ``store`` is given, dead and cleared hosts are recorded there,
+    see :class:`soweego.commons.url_store.URLStore`.
+    """
+
+    def __init__(self, max_failures=MAX_HOST_FAILURES, suspected_hosts=(), store=None):
+        self.max_failures = max_failures
+        self.dead_hosts = set()
+        self.suspected_hosts = set(suspected_hosts)
+        self.store = store
+        # Requests not fired because their host is dead
+        self.avoided = 0
+        self._failures = Counter()
+        self._lock = threading.Lock()
+
+    def is_dead(self, host) -> bool:
+        """Tell whether a host is dead, counting an avoided request if so."""
+        if host not in self.dead_hosts:
+            return False
+        self.count_avoided()
+        return True
+
+    def is_suspected(self, host) -> bool:
+        """Tell whether a host found dead by a previous run still awaits its probe."""
+        return host in self.suspected_hosts
+
+    def count_avoided(self, requests=1):
+        with self._lock:
+            self.avoided += requests
+
+    def report(self, host, unreachable) -> bool:
+        """Record the outcome of a request to a host.
+        Return ``True`` if the host has just become dead.
+        """
+        with self._lock:
+            suspected = host in self.suspected_hosts
+            self.suspected_hosts.discard(host)
+            if not unreachable:
+                self._failures.pop(host, None)
+                cleared = suspected
+            elif host in self.dead_hosts:
+                return False
+            else:
+                self._failures[host] += 1
+                if not suspected and self._failures[host] < self.max_failures:
+                    return False
+                failures = self._failures.pop(host)
+                self.dead_hosts.add(host)
+                cleared = False
+        if unreachable:
+            LOGGER.warning(
+                'Host %s is unreachable after %d consecutive failures, dropping its URLs for the rest of the run', host, failures)
+            if self.store is not None:
+                self.store.add_dead_host(host)
+            return True
+        if cleared:
+            LOGGER.info('Host %s, found dead by a previous run, is reachable again', host)
+            if self.store is not None:
+                self.store.remove_dead_host(host)
+        return False
+
+
+def get_breaker() -> HostBreaker:
+    """Return the circuit breaker of this run, which suspects
+    the dead hosts recently found by previous ones, see :mod:`soweego.commons.url_store`.
+    """
+    global _breaker
+    if _breaker is None:
+        store = url_store.get_store()
+        _breaker = HostBreaker(
+            suspected_hosts=store.dead_hosts(), store=store)
+    return _breaker
+
+
 def clean(url):
     stripped = url.strip()
     if ' ' in stripped:
@@ -95,8 +196,34 @@ def validate(url):
     return valid_url.group()
 
 
-@lru_cache()
 def resolve(url):
+    """Return the URL that the given one resolves to, ``None`` if it is dead.
+    Resolutions are looked up in the URL store first,
+    see :mod:`soweego.commons.url_store`.
+    """
+    store = url_store.get_store()
+    known = store.lookup([url])
+    if url in known:
+        return known[url][0]
+    host = urlsplit(url).hostname
+    breaker = get_breaker()
+    if breaker.is_dead(host):
+        LOGGER.debug('Dropping URL of dead host %s: <%s>', host, url)
+        return None
+    resolved, status, unreachable = _request(url)
+    breaker.report(host, unreachable)
+    # Network errors are often transient: don't remember them
+    if not unreachable:
+        store.record([(url, resolved, status)])
+    return resolved
+
+
+def _request(url) -> tuple:
+    """Fire an HTTP request to a URL.
+    Return the resolved URL, ``None`` if it is dead, the HTTP status,
+    ``None`` if there is no response, and whether the host was unreachable,
+    i.e., the request timed out or the connection failed.
+    """
     # Don't show warnings in case of unverified HTTPS requests
     disable_warnings(InsecureRequestWarning)
     # Some Web sites return 4xx just because of a non-browser user agent header
@@ -110,31 +237,38 @@ def resolve(url):
         LOGGER.debug(
             'SSL certificate verification failed, will retry without verification. Original URL: <%s> - Reason: %s', url, ssl_error)
         try:
-            response = get(url, headers=browser_ua, stream=True, verify=False)
+            response = get(url, headers=browser_ua, stream=True,
+                           verify=False, timeout=READ_TIMEOUT)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as network_error:
+            LOGGER.info(
+                'Dropping URL that led to a network error without SSL verification: <%s> - Reason: %s', url, network_error)
+            return None, None, True
         except Exception as unexpected_error:
             LOGGER.warning(
                 'Dropping URL that led to an unexpected error: <%s> - Reason: %s', url, unexpected_error)
-            return None
+            return None, None, False
     except requests.exceptions.Timeout as timeout:
         LOGGER.info(
             'Dropping URL that led to a request timeout: <%s> - Reason: %s', url, timeout)
-        return None
+        return None, None, True
     except requests.exceptions.TooManyRedirects as too_many_redirects:
         LOGGER.info(
             'Dropping URL because of too many redirects: <%s> - %s', url, too_many_redirects)
-        return None
+        return None, None, False
     except requests.exceptions.ConnectionError as connection_error:
         LOGGER.info(
             'Dropping URL that led to an aborted connection: <%s> - Reason: %s', url, connection_error)
-        return None
+        return None, None, True
     except Exception as unexpected_error:
         LOGGER.warning(
             'Dropping URL that led to an unexpected error: <%s> - Reason: %s', url, unexpected_error)
-        return None
+        return None, None, False
+    # Release the connection: the body is never read
+    response.close()
     if not response.ok:
         LOGGER.info(
             "Dropping dead URL that returned HTTP status '%s' (%d): <%s>", response.reason, response.status_code, url)
-        return None
+        return None, response.status_code, False
     resolved = response.url
     history = response.history
     if len(history) > 1:
@@ -142,7 +276,110 @@ def resolve(url):
                      r.url for r in history])
     else:
         LOGGER.debug('Original URL: <%s> - Resolved URL: <%s>', url, resolved)
-    return resolved
+    return resolved, response.status_code, False
+
+
+def resolve_many(urls: Iterable[str], workers=RESOLVE_WORKERS, per_host=RESOLVE_PER_HOST,
+                 buffer_size=RESOLVE_BUFFER_SIZE) -> Iterator[tuple]:
+    """Resolve URLs concurrently and yield ``(url, resolved)`` pairs
+    as soon as each resolution completes, see :func:`resolve`.
+
+    URLs are looked up in the URL store in batches, and only
+    the missing or expired ones are requested, unless their host is dead,
+    see :class:`HostBreaker`.
+    At most ``workers`` requests are in flight, and at most ``per_host``
+    of them target the same host, or just one if the host is suspected. The input is consumed lazily:
+    at most ``buffer_size`` URLs wait for a free slot.
+    Duplicate URLs are resolved once per occurrence,
+    so callers should pass distinct ones.
+    """
+    store = url_store.get_store()
+    breaker = get_breaker()
+    urls = iter(urls)
+    exhausted = False
+    waiting = defaultdict(deque)
+    waiting_count = 0
+    in_flight = Counter()
+    # Hosts with waiting URLs and a free slot, served round-robin
+    ready, ready_set = deque(), set()
+    futures = {}
+    # Fresh resolutions not yet written to the store
+    checked = []
+
+    def mark_ready(host):
+        # Suspected hosts get a single probe, not a burst
+        limit = 1 if breaker.is_suspected(host) else per_host
+        if host not in ready_set and waiting.get(host) and in_flight[host] < limit:
+            ready.append(host)
+            ready_set.add(host)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                while not exhausted and waiting_count < buffer_size:
+                    batch = list(islice(urls, min(
+                        STORE_BATCH_SIZE, buffer_size - waiting_count)))
+                    if not batch:
+                        exhausted = True
+                        break
+                    known = store.lookup(batch)
+                    for url in batch:
+                        if url in known:
+                            yield url, known[url][0]
+                            continue
+                        host = urlsplit(url).hostname
+                        if breaker.is_dead(host):
+                            yield url, None
+                            continue
+                        waiting[host].append(url)
+                        waiting_count += 1
+                        mark_ready(host)
+
+                while ready and len(futures) < workers:
+                    host = ready.popleft()
+                    ready_set.discard(host)
+                    url = waiting[host].popleft()
+                    waiting_count -= 1
+                    in_flight[host] += 1
+                    futures[executor.submit(_request, url)] = (url, host)
+                    if waiting[host]:
+                        mark_ready(host)
+                    else:
+                        del waiting[host]
+
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, host = futures.pop(future)
+                    in_flight[host] -= 1
+                    if not in_flight[host]:
+                        del in_flight[host]
+                    resolved, status, unreachable = future.result()
+                    # Network errors are often transient: don't remember them
+                    if not unreachable:
+                        checked.append((url, resolved, status))
+                    if len(checked) >= STORE_BATCH_SIZE:
+                        store.record(checked)
+                        checked = []
+                    yield url, resolved
+
+                    if breaker.report(host, unreachable):
+                        # Drop the URLs still waiting for the dead host
+                        dropped = waiting.pop(host, ())
+                        waiting_count -= len(dropped)
+                        breaker.count_avoided(len(dropped))
+                        if host in ready_set:
+                            ready.remove(host)
+                            ready_set.discard(host)
+                        for dropped_url in dropped:
+                            yield dropped_url, None
+                    mark_ready(host)
+        finally:
+            # Keep what was checked, even if the caller stops early
+            if checked:
+                store.record(checked)
 
 
 def tokenize(url, domain_only=False) -> set:
@@ -166,34 +403,121 @@ def tokenize(url, domain_only=False) -> set:
     return tokens
 
 
-def get_external_id_from_url(url, ext_id_pids_to_urls):
-    LOGGER.debug('Trying to extract an identifier from URL <%s>', url)
-    url = url.rstrip('/')
-    for pid, formatters in ext_id_pids_to_urls.items():
-        for formatter_url, formatter_regex in formatters.items():
-            before, _, after = formatter_url.partition('$1')
-            after = after.rstrip('/')
-            if url.startswith(before) and url.endswith(after):
+class FormatterIndex(Mapping):
+
+    """Formatter URLs of external identifiers, keyed by their literal prefix,
+    i.e., the part before ``$1``.
+
+    Read as a ``{external_ID_PID: {formatter_URL: formatter_regex}}`` mapping.
+    Formatter regexes may be strings, compiled on first use, or compiled patterns.
+    Finding the formatters of a URL takes a dictionary lookup per distinct
+    prefix length up to the URL length, instead of a scan of all the formatters.
+    """
+
+    def __init__(self, ext_id_pids_to_urls: dict):
+        self._pids = ext_id_pids_to_urls
+        by_prefix = defaultdict(list)
+        for pid, formatters in ext_id_pids_to_urls.items():
+            for formatter_url, formatter_regex in formatters.items():
+                before, _, after = formatter_url.partition('$1')
+                by_prefix[before].append(
+                    (after.rstrip('/'), pid, formatter_url, formatter_regex))
+        self._by_prefix = dict(by_prefix)
+        # Longest prefixes first: they are the most specific
+        self._prefix_lengths = sorted(
+            {len(prefix) for prefix in by_prefix}, reverse=True)
+        self._compiled = {}
+
+    @classmethod
+    def from_results(cls, results: Iterable[dict]) -> 'FormatterIndex':
+        """Build the index from ``{external_ID_PID: {formatter_URL: formatter_regex}}``
+        results, as yielded by :func:`soweego.wikidata.sparql_queries.external_id_pids_and_urls_query`.
+        """
+        ext_id_pids_to_urls = defaultdict(dict)
+        for result in results:
+            for pid, formatters in result.items():
+                ext_id_pids_to_urls[pid].update(formatters)
+        return cls(dict(ext_id_pids_to_urls))
+
+    def __getitem__(self, pid):
+        return self._pids[pid]
+
+    def __iter__(self):
+        return iter(self._pids)
+
+    def __len__(self):
+        return len(self._pids)
+
+    def extract(self, url) -> tuple:
+        """Return the ``(external_ID, PID)`` pair of a URL,
+        ``(None, None)`` if it does not match any formatter.
+        """
+        LOGGER.debug('Trying to extract an identifier from URL <%s>', url)
+        url = url.rstrip('/')
+        for length in self._prefix_lengths:
+            if length > len(url):
+                continue
+            for after, pid, formatter_url, formatter_regex in self._by_prefix.get(url[:length], ()):
+                if len(url) < length + len(after) or not url.endswith(after):
+                    continue
                 LOGGER.debug(
                     'Input URL matches external ID formatter URL: <%s> -> <%s>', url, formatter_url)
-                url_fragment = url[len(before):-len(after)
-                                   ] if len(after) else url[len(before):]
+                url_fragment = url[length:len(url) - len(after)]
                 if not formatter_regex:
                     LOGGER.debug(
                         'Missing formatter regex, will assume the URL substring as the ID. URL: %s - URL substring: %s', url, url_fragment)
                     return url_fragment, pid
-                ext_id_match = regex.search(formatter_regex, url_fragment) if isinstance(
-                    formatter_regex, regex.Pattern) else re.search(formatter_regex, url_fragment)
+                compiled_regex = self._compile(formatter_regex)
+                ext_id_match = compiled_regex.search(
+                    url_fragment) if compiled_regex else None
                 if not ext_id_match:
                     LOGGER.debug(
-                        "Skipping target URL <%s> with fragment '%s' not matching the expected formatter regex %s", url, url_fragment, formatter_regex.pattern)
-                    return None, None
+                        "Skipping formatter URL <%s>: fragment '%s' of target URL <%s> does not match the expected formatter regex %s", formatter_url, url_fragment, url, formatter_regex)
+                    continue
                 ext_id = ext_id_match.group()
                 LOGGER.debug('URL: %s - URL substring: %s - formatter regex: %s - extracted ID: %s',
                              url, url_fragment, formatter_regex, ext_id)
                 return ext_id, pid
-    LOGGER.debug('Could not extract any identifier from URL <%s>', url)
-    return None, None
+        LOGGER.debug('Could not extract any identifier from URL <%s>', url)
+        return None, None
+
+    def _compile(self, formatter_regex):
+        if not isinstance(formatter_regex, str):
+            return formatter_regex
+        if formatter_regex not in self._compiled:
+            self._compiled[formatter_regex] = compile_formatter_regex(
+                formatter_regex)
+        return self._compiled[formatter_regex]
+
+
+def compile_formatter_regex(formatter_regex):
+    """Compile a formatter regex, falling back to the ``regex`` third-party
+    library for syntax unsupported by ``re``.
+    Return ``None`` if neither can compile it.
+    """
+    try:
+        return re.compile(formatter_regex)
+    except re.error:
+        LOGGER.debug(
+            "Using 'regex' third-party library. Formatter regex not supported by the 're' standard library: %s", formatter_regex)
+    try:
+        return regex.compile(formatter_regex)
+    except regex.error as error:
+        LOGGER.warning(
+            'Skipping invalid formatter regex %s - Reason: %s', formatter_regex, error)
+        return None
+
+
+def get_external_id_from_url(url, ext_id_pids_to_urls):
+    """Extract an external identifier from a URL, see :meth:`FormatterIndex.extract`.
+
+    :param ext_id_pids_to_urls: a :class:`FormatterIndex`, or
+     a ``{external_ID_PID: {formatter_URL: formatter_regex}}`` dictionary,
+     indexed on the fly. Build the index once when handling several URLs
+    """
+    if not isinstance(ext_id_pids_to_urls, FormatterIndex):
+        ext_id_pids_to_urls = FormatterIndex(ext_id_pids_to_urls)
+    return ext_id_pids_to_urls.extract(url)
 
 
 def is_wiki_link(url):
@@ -10,6 +10,7 @@ __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import logging
+from itertools import islice
 
 LOGGER = logging.getLogger(__name__)
 
@@ -21,3 +22,12 @@ def make_buckets(dataset, bucket_size=1000):
     LOGGER.info('Made %s buckets of size %s from a dataset of size %s',
                 len(buckets), bucket_size, len(dataset))
     return buckets
+
+
+def stream_buckets(iterable, bucket_size=1000):
+    """Lazily slice an iterable into lists of at most ``bucket_size`` items."""
+    iterator = iter(iterable)
+    bucket = list(islice(iterator, bucket_size))
+    while bucket:
+        yield bucket
+        bucket = list(islice(iterator, bucket_size))
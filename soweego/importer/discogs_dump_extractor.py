@@ -16,7 +16,7 @@ from datetime import date, datetime
 
 from requests import get
 
-from soweego.commons import text_utils, url_utils
+from soweego.commons import text_utils, url_utils, utils
 from soweego.commons.db_manager import DBManager
 from soweego.importer.base_dump_extractor import BaseDumpExtractor
 from soweego.importer.models import discogs_entity
@@ -26,6 +26,8 @@ LOGGER = logging.getLogger(__name__)
 
 DUMP_BASE_URL = 'https://discogs-data.s3-us-west-2.amazonaws.com/'
 DUMP_LIST_URL_TEMPLATE = DUMP_BASE_URL + '?delimiter=/&prefix=data/{}/'
+# Artists whose links are resolved together
+LINK_CHECK_BATCH_SIZE = 1000
 
 
 class DiscogsDumpExtractor(BaseDumpExtractor):
@@ -68,56 +70,44 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
                     [table.__tablename__ for table in tables])
 
         with gzip.open(dump_file_path, 'rt') as dump:
-            for _, node in et.iterparse(dump):
-                if not node.tag == 'artist':
-                    continue
-
-                # Skip nodes without required fields
-                identifier = node.findtext('id')
-                if not identifier:
-                    LOGGER.warning(
-                        'Skipping import for artist node with no identifier: %s', node)
-                    continue
-                name = node.findtext('name')
-                if not name:
-                    LOGGER.warning(
-                        'Skipping import for identifier with no name: %s', identifier)
-                    continue
-
-                living_links = self._extract_living_links(node, identifier)
-
-                session = db_manager.new_session()
-
-                # Musician
-                groups = node.find('groups')
-                members = node.find('members')
-                if groups:
-                    entity = discogs_entity.DiscogsMusicianEntity()
-                    self._populate_musician(
-                        entity, identifier, name, living_links, node, session)
-                # Band
-                elif members:
-                    entity = discogs_entity.DiscogsGroupEntity()
-                    self._populate_band(entity, identifier,
-                                        name, living_links, node, session)
-                # Can't infer the entity type, so populate both
-                else:
-                    LOGGER.debug(
-                        'Unknown artist type. Will add it to both musicians and bands: %s', identifier)
-                    entity = discogs_entity.DiscogsMusicianEntity()
-                    self._populate_musician(
-                        entity, identifier, name, living_links, node, session)
-                    entity = discogs_entity.DiscogsGroupEntity()
-                    self._populate_band(entity, identifier,
-                                        name, living_links, node, session)
-
-                session.commit()
+            # Resolve the links of a batch of artists concurrently
+            for batch in utils.stream_buckets(self._artist_nodes(dump), LINK_CHECK_BATCH_SIZE):
+                living_links = self._check_links(batch)
+
+                for identifier, name, node in batch:
+                    session = db_manager.new_session()
+                    links = living_links[identifier]
+
+                    # Musician
+                    groups = node.find('groups')
+                    members = node.find('members')
+                    if groups:
+                        entity = discogs_entity.DiscogsMusicianEntity()
+                        self._populate_musician(
+                            entity, identifier, name, links, node, session)
+                    # Band
+                    elif members:
+                        entity = discogs_entity.DiscogsGroupEntity()
+                        self._populate_band(entity, identifier,
+                                            name, links, node, session)
+                    # Can't infer the entity type, so populate both
+                    else:
+                        LOGGER.debug(
+                            'Unknown artist type. Will add it to both musicians and bands: %s', identifier)
+                        entity = discogs_entity.DiscogsMusicianEntity()
+                        self._populate_musician(
+                            entity, identifier, name, links, node, session)
+                        entity = discogs_entity.DiscogsGroupEntity()
+                        self._populate_band(entity, identifier,
+                                            name, links, node, session)
+
+                    session.commit()
                 LOGGER.debug('%d entities imported so far: %d musicians with %d links, %d bands with %d links, %d discarded dead links.',
                              self.total_entities, self.musicians, self.musician_links, self.bands, self.band_links, self.dead_links)
 
         end = datetime.now()
-        LOGGER.info('Import completed in %s. Total entities: %d - %d musicians with %d links - %d bands with %d links - %d discarded dead links.',
-                    end - start, self.total_entities, self.musicians, self.musician_links, self.bands, self.band_links, self.dead_links)
+        LOGGER.info('Import completed in %s. Total entities: %d - %d musicians with %d links - %d bands with %d links - %d discarded dead links - %d requests to dead hosts avoided.',
+                    end - start, self.total_entities, self.musicians, self.musician_links, self.bands, self.band_links, self.dead_links, url_utils.get_breaker().avoided)
 
     def _populate_band(self, entity: discogs_entity.DiscogsGroupEntity, identifier, name, links, node, session):
         # Main entity
@@ -195,6 +185,8 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
         # Required fields
         entity.catalog_id = identifier
         entity.name = name
+        # Memoized: artists of unknown type get tokenized once
+        entity.tokens = ' '.join(text_utils.tokenize_many([name])[0])
         # Real name
         real_name = artist_node.findtext('realname')
         if real_name:
@@ -212,15 +204,18 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
     def _denormalize_name_variation_entities(self, main_entity: discogs_entity.DiscogsBaseEntity, name_variation_nodes):
         entity_class = type(main_entity)
+        name_variations = []
         for node in name_variation_nodes:
-            name_variation = node.text
-            if not name_variation:
+            if not node.text:
                 LOGGER.debug(
                     'Artist %s: skipping empty <name> tag in <namevariations>', main_entity.catalog_id)
                 continue
+            name_variations.append(node.text)
+        for name_variation, tokens in zip(name_variations, text_utils.tokenize_many(name_variations)):
             variation_entity = entity_class()
             variation_entity.catalog_id = main_entity.catalog_id
             variation_entity.name = name_variation
+            variation_entity.tokens = ' '.join(tokens)
             variation_entity.real_name = main_entity.real_name
             variation_entity.data_quality = main_entity.data_quality
             self.total_entities += 1
@@ -230,8 +225,46 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
                 self.bands += 1
             yield variation_entity
 
-    def _extract_living_links(self, artist_node, identifier):
-        LOGGER.debug('Extracting living links from artist %s', identifier)
+    def _artist_nodes(self, dump):
+        for _, node in et.iterparse(dump):
+            if not node.tag == 'artist':
+                continue
+
+            # Skip nodes without required fields
+            identifier = node.findtext('id')
+            if not identifier:
+                LOGGER.warning(
+                    'Skipping import for artist node with no identifier: %s', node)
+                continue
+            name = node.findtext('name')
+            if not name:
+                LOGGER.warning(
+                    'Skipping import for identifier with no name: %s', identifier)
+                continue
+
+            yield identifier, name, node
+
+    def _check_links(self, artists) -> dict:
+        """Return the living links of each ``(identifier, name, node)`` artist."""
+        valid_links = {identifier: list(self._extract_valid_links(node, identifier))
+                       for identifier, _, node in artists}
+        resolved = dict(url_utils.resolve_many(
+            {link for links in valid_links.values() for link in links}))
+        living_links = {}
+        for identifier, links in valid_links.items():
+            living_links[identifier] = []
+            for link in links:
+                alive = resolved[link]
+                if not alive:
+                    self.dead_links += 1
+                    continue
+                LOGGER.debug('Living URL: <%s>', alive)
+                self.valid_links += 1
+                living_links[identifier].append(alive)
+        return living_links
+
+    def _extract_valid_links(self, artist_node, identifier):
+        LOGGER.debug('Extracting valid links from artist %s', identifier)
         urls = artist_node.find('urls')
         if urls:
             for url_element in urls.iterfind('url'):
@@ -240,8 +273,8 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
                     LOGGER.debug(
                         'Artist %s: skipping empty <url> tag', identifier)
                     continue
-                for alive_link in self._check_link(url):
-                    yield alive_link
+                for valid_link in self._check_link(url):
+                    yield valid_link
 
     def _check_link(self, link):
         LOGGER.debug('Processing link <%s>', link)
@@ -253,13 +286,7 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
                 self.dead_links += 1
                 continue
             LOGGER.debug('Valid URL: <%s>', valid)
-            alive = url_utils.resolve(valid)
-            if not alive:
-                self.dead_links += 1
-                continue
-            LOGGER.debug('Living URL: <%s>', alive)
-            self.valid_links += 1
-            yield alive
+            yield valid
 
     def _fill_link_entity(self, entity: BaseLinkEntity, identifier, url):
         entity.catalog_id = identifier
@@ -15,8 +15,11 @@ import os
 
 import click
 
+from soweego.commons import cache
 from soweego.commons import constants as const
 from soweego.commons import http_client as client
+from soweego.commons import deletion_index, url_store
+from soweego.commons.deletion_index import DeletionIndex
 from soweego.importer.base_dump_extractor import BaseDumpExtractor
 from soweego.importer.discogs_dump_extractor import DiscogsDumpExtractor
 from soweego.importer.musicbrainz_dump_extractor import \
@@ -29,8 +32,17 @@ LOGGER = logging.getLogger(__name__)
 @click.argument('catalog', type=click.Choice(['discogs', 'musicbrainz']))
 @click.option('--download-url', '-du', default=None)
 @click.option('--output', '-o', default='/app/shared', type=click.Path())
-def import_cli(catalog: str, download_url: str, output: str) -> None:
+@click.option('--deletion-index/--no-deletion-index', 'use_deletion_index', default=False,
+              help='Rebuild the deletion indices of catalog names used by the linker in the output folder. Default: no.')
+@click.option('--url-store', 'store_path', type=click.Path(dir_okay=False), default=None,
+              help='SQLite file of URL resolutions shared across imports. Default: %s in the output folder.' % url_store.STORE_FILE_NAME)
+@click.option('--recheck-days', type=click.IntRange(min=0), default=url_store.RECHECK_INTERVAL_DAYS,
+              help='Check again stored URL resolutions older than this amount of days. Default: %d.' % url_store.RECHECK_INTERVAL_DAYS)
+def import_cli(catalog: str, download_url: str, output: str, use_deletion_index: bool, store_path: str, recheck_days: int) -> None:
     """Download, extract and import an available catalog."""
+    if store_path is None:
+        store_path = os.path.join(output, url_store.STORE_FILE_NAME)
+    url_store.set_store(url_store.URLStore(store_path, recheck_days))
     importer = Importer()
     extractor = BaseDumpExtractor()
 
@@ -40,14 +52,19 @@ def import_cli(catalog: str, download_url: str, output: str) -> None:
         extractor = MusicBrainzDumpExtractor()
 
     importer.refresh_dump(
-        output, download_url, extractor)
+        output, download_url, extractor, catalog)
+
+    if use_deletion_index:
+        importer.rebuild_deletion_indices(output, catalog)
 
 
 class Importer():
 
-    def refresh_dump(self, output_folder: str, download_url: str, downloader: BaseDumpExtractor):
+    def refresh_dump(self, output_folder: str, download_url: str, downloader: BaseDumpExtractor, catalog: str = None):
         """Downloads the dump, if necessary, 
-        and calls the handler over the dump file"""
+        and calls the handler over the dump file.
+        If ``catalog`` is given, records the dump date as the
+        catalog data version of cached results"""
 
         try:
             last_modified = client.http_call(download_url,
@@ -67,6 +84,11 @@ class Importer():
 
         file_full_path = os.path.join(output_folder, file_name)
 
+        # Results cached while the tables are being filled are never reused
+        if catalog:
+            cache.set_catalog_version(
+                catalog, 'importing %s' % last_modified)
+
         # Check if the current dump is up-to-date
         if os.path.isfile(file_full_path):
             downloader.extract_and_populate(file_full_path)
@@ -74,6 +96,19 @@ class Importer():
             self._update_dump(download_url, file_full_path)
             downloader.extract_and_populate(file_full_path)
 
+        if catalog:
+            cache.set_catalog_version(catalog, last_modified)
+
+    def rebuild_deletion_indices(self, output_folder: str, catalog: str) -> None:
+        """Build the deletion index of every entity table of the given catalog
+        and store it in the output folder"""
+        for catalog_entity in const.TARGET_CATALOGS[catalog].values():
+            entity = catalog_entity['entity']
+            if entity is None:
+                continue
+            DeletionIndex.build(entity).dump(
+                deletion_index.index_path(output_folder, entity))
+
     def _update_dump(self, dump_url: str, file_output_path: str) -> None:
         """Download the dump"""
         client.download_file(dump_url, file_output_path)
@@ -11,7 +11,6 @@ __copyright__ = 'Copyleft 2018, MaxFrax96'
 
 import logging
 import os
-import re
 import tarfile
 from collections import defaultdict
 from csv import DictReader
@@ -28,11 +27,14 @@ from soweego.importer.models.musicbrainz_entity import (ARTIST_TABLE,
                                                         MusicbrainzArtistLinkEntity,
                                                         MusicbrainzBandEntity,
                                                         MusicbrainzBandLinkEntity)
-from soweego.wikidata.sparql_queries import external_id_pids_and_urls_query
+from soweego.wikidata import pid_registry
 from sqlalchemy.exc import IntegrityError
 
 LOGGER = logging.getLogger(__name__)
 
+# International Standard Name Identifier
+ISNI_PID = 'P213'
+
 
 class MusicBrainzDumpExtractor(BaseDumpExtractor):
 
@@ -125,7 +127,7 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
                     urlid_artistid_relationship[relationship[3]
                                                 ] = relationship[2]
 
-        url_artistid = {}
+        candidate_url_artistid = {}
         url_path = os.path.join(dump_path, 'mbdump', 'url')
         # Translates URL IDs to the relative URL
         with open(url_path, "r") as tsvfile:
@@ -138,13 +140,18 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
                     for candidate_url in url_utils.clean(url_record[2]):
                         if not url_utils.validate(candidate_url):
                             continue
-                        if not url_utils.resolve(candidate_url):
-                            continue
-                        url_artistid[candidate_url] = urlid_artistid_relationship[urlid]
-                        del urlid_artistid_relationship[urlid]
+                        candidate_url_artistid[candidate_url] = urlid_artistid_relationship[urlid]
 
         urlid_artistid_relationship = None
 
+        # Keeps living URLs only
+        url_artistid = {}
+        for candidate_url, resolved in url_utils.resolve_many(candidate_url_artistid.keys()):
+            if resolved:
+                url_artistid[candidate_url] = candidate_url_artistid[candidate_url]
+
+        candidate_url_artistid = None
+
         artistid_url = defaultdict(list)
         # Inverts dictionary
         for url, artistid in url_artistid.items():
@@ -173,30 +180,40 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
 
         artist_link = {}
 
-        done = False
-        for result in external_id_pids_and_urls_query():
-            if done:
-                break
-            for pid, formatter in result.items():
-                if pid == 'P213':
-                    for url_formatter, regex in formatter.items():
-                        r = re.compile(regex)
-
-                        with open(isni_file_path, 'r') as artistfile:
-                            for artistid_isni in DictReader(artistfile, delimiter='\t', fieldnames=['id', 'isni']):
-                                # If ISNI is valid, generates an url for the artist
-                                artistid = artistid_isni['id']
-                                isni = artistid_isni['isni']
-
-                                link = url_formatter.replace(
-                                    '$1', isni)
-                                for candidate_url in url_utils.clean(link):
-                                    if not url_utils.validate(candidate_url):
-                                        continue
-                                    if not url_utils.resolve(candidate_url):
-                                        continue
-                                    artist_link[artistid] = candidate_url
-                    done = True
+        _, ext_id_pids_to_urls = pid_registry.load()
+        isni_formatters = ext_id_pids_to_urls.get(ISNI_PID)
+        if not isni_formatters:
+            LOGGER.warning(
+                'No formatter URL for ISNI (%s), skipping ISNI links', ISNI_PID)
+            return
+        # {candidate URL: (artist ID, formatter rank)}
+        candidate_url_artistid = {}
+        with open(isni_file_path, 'r') as artistfile:
+            for artistid_isni in DictReader(artistfile, delimiter='\t', fieldnames=['id', 'isni']):
+                # If ISNI is valid, generates an url for the artist
+                artistid = artistid_isni['id']
+                isni = artistid_isni['isni']
+
+                # Try every formatter URL, since any of them may be dead
+                for rank, url_formatter in enumerate(isni_formatters):
+                    link = url_formatter.replace('$1', isni)
+                    for candidate_url in url_utils.clean(link):
+                        if not url_utils.validate(candidate_url):
+                            continue
+                        candidate_url_artistid[candidate_url] = (
+                            artistid, rank)
+
+        # One link per ISNI is enough: the one of the last formatter that resolves,
+        # whatever order the resolutions complete in
+        artist_rank = {}
+        for candidate_url, resolved in url_utils.resolve_many(candidate_url_artistid.keys()):
+            if not resolved:
+                continue
+            artistid, rank = candidate_url_artistid[candidate_url]
+            if rank >= artist_rank.get(artistid, -1):
+                artist_rank[artistid] = rank
+                artist_link[artistid] = candidate_url
+        artist_rank = None
 
         artist_path = os.path.join(dump_path, 'mbdump', 'artist')
         with open(artist_path, 'r') as artistfile:
@@ -332,7 +349,8 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
     def _fill_entity(self, entity, info, areas):
         entity.catalog_id = info['gid']
         entity.name = info['label']
-        entity.tokens = " ".join(text_utils.tokenize(info['label']))
+        # Memoized: artists that are also bands get tokenized once
+        entity.tokens = " ".join(text_utils.tokenize_many([info['label']])[0])
         birth_date = self._get_date_and_precision(
             info['b_year'], info['b_month'], info['b_day'])
         death_date = self._get_date_and_precision(
@@ -359,7 +377,7 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
             url_utils.tokenize(link))
 
     def _alias_entities(self, entity: BaseEntity, aliases_class, aliases: []):
-        for alias_label in aliases:
+        for alias_label, alias_tokens in zip(aliases, text_utils.tokenize_many(aliases)):
             alias_entity = aliases_class()
             alias_entity.catalog_id = entity.catalog_id
             alias_entity.born = entity.born
@@ -370,7 +388,7 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
             alias_entity.death_place = entity.death_place
 
             alias_entity.name = alias_label
-            alias_entity.tokens = " ".join(url_utils.tokenize(alias_label))
+            alias_entity.tokens = " ".join(alias_tokens)
             yield alias_entity
 
     def _get_date_and_precision(self, year, month, day):
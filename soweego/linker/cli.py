@@ -1,8 +1,9 @@
 import click
-from soweego.linker import linking_strategies
+from soweego.linker import linking_strategies, minhash_index
 
 CLI_COMMANDS = {
-    'baseline': linking_strategies.baseline
+    'baseline': linking_strategies.baseline,
+    'minhash_recall': minhash_index.minhash_recall
 }
 
 
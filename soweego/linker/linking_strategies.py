@@ -11,22 +11,48 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import json
 import logging
-from collections import defaultdict
+import shutil
+import tempfile
+from collections import defaultdict, deque
+from multiprocessing import Pool
 from os import path
+from typing import Iterator
 
 import click
-import jellyfish
-from soweego.commons import (data_gathering, target_database, text_utils,
-                             url_utils)
+import numpy
+from soweego.commons import (cache, data_gathering, deletion_index, similarity,
+                             target_database, text_utils, url_utils, utils)
+from soweego.commons.deletion_index import DeletionIndex
 from soweego.importer.models.base_entity import BaseEntity
 from soweego.importer.models.base_link_entity import BaseLinkEntity
+from soweego.linker import minhash_index
+from soweego.linker.minhash_index import MinHashIndex
+from soweego.linker.token_index import TokenIndex
 
 LOGGER = logging.getLogger(__name__)
+# Batch scorers of one source string against many target candidates
 EDIT_DISTANCES = {
-    'jw': jellyfish.jaro_winkler,
-    'l': jellyfish.levenshtein_distance,
-    'dl': jellyfish.damerau_levenshtein_distance
+    'jw': similarity.jaro_winkler,
+    'l': similarity.levenshtein,
+    'dl': similarity.damerau_levenshtein
 }
+# Target columns read by each strategy, the only ones fetched from the DB
+SIMILAR_MATCH_COLUMNS = ('catalog_id', 'tokens')
+EDIT_DISTANCE_COLUMNS = ('catalog_id', 'name')
+# Amount of source strings looked up together by the perfect match strategy
+PERFECT_MATCH_BUCKET_SIZE = 1000
+# Amount of source items sharing the same candidate retrieval query
+SHARED_CANDIDATES_BUCKET_SIZE = 100
+# Cascade strategies, from the cheapest to the most expensive one
+CASCADE_STRATEGIES = ('perfect', 'names', 'links')
+# Amount of source items handed to a worker process at a time
+WORKER_CHUNK_SIZE = 1000
+# Amount of chunks each worker process can have queued
+WORKER_CHUNKS_QUEUE_SIZE = 2
+
+# State of worker processes, see _init_worker
+_WORKER_MATCH_FUNCTION = None
+_WORKER_ARGS = ()
 
 
 @click.command()
@@ -36,7 +62,29 @@ EDIT_DISTANCES = {
 @click.option('-s', '--strategy', type=click.Choice(['perfect', 'links', 'names', 'edit_distance', 'all']), default='all')
 @click.option('-o', '--output-dir', type=click.Path(file_okay=False), default='/app/shared',
               help="default: 'output'")
-def baseline(source, target, target_type, strategy, output_dir):
+@click.option('-b', '--backend', type=click.Choice(['fulltext', 'index', 'minhash']), default='fulltext',
+              help="Where similar names and links are looked up: 'fulltext' = MySQL FULLTEXT queries, 'index' = in-memory token index, 'minhash' = in-memory MinHash index for links only. Default: 'fulltext'.")
+@click.option('--minhash-bands', type=click.IntRange(min=1), default=minhash_index.DEFAULT_BANDS,
+              help='Number of bands of the MinHash index. Default: %d.' % minhash_index.DEFAULT_BANDS)
+@click.option('--minhash-rows', type=click.IntRange(min=1), default=minhash_index.DEFAULT_ROWS,
+              help='Number of rows per band of the MinHash index. Default: %d.' % minhash_index.DEFAULT_ROWS)
+@click.option('--minhash-threshold', type=click.FloatRange(0, 1), default=minhash_index.DEFAULT_THRESHOLD,
+              help='Minimum Jaccard similarity of MinHash link matches. Default: %s.' % minhash_index.DEFAULT_THRESHOLD)
+@click.option('-m', '--metric', type=click.Choice(EDIT_DISTANCES.keys()), default='jw',
+              help="Edit distance used by the 'edit_distance' strategy. Default: 'jw'.")
+@click.option('-t', '--threshold', type=float, default=0,
+              help="Edit distance threshold used by the 'edit_distance' strategy. Default: 0.")
+@click.option('--deletion-index/--no-deletion-index', 'use_deletion_index', default=False,
+              help="Get 'l' and 'dl' edit distance candidates from the deletion index stored in the output directory. Default: no.")
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1,
+              help='Number of worker processes sharing the source dataset. Default: 1.')
+@click.option('--stream/--no-stream', default=False,
+              help='Read SOURCE as JSON lines and write each match as a JSON line as soon as it is found. Default: no.')
+@click.option('--cascade/--no-cascade', default=False,
+              help="With the 'all' strategy, only match source items left unresolved by the previous strategies. Default: no.")
+@click.option('--shared-candidates/--no-shared-candidates', default=False,
+              help="With the 'all' strategy, fetch target candidates once for both 'perfect' and 'names'. Default: no.")
+def baseline(source, target, target_type, strategy, output_dir, backend, minhash_bands, minhash_rows, minhash_threshold, metric, threshold, use_deletion_index, workers, stream, cascade, shared_candidates):
     """Rule-based matching strategies.
 
     SOURCE must be {string: identifier} JSON files.
@@ -49,75 +97,424 @@ def baseline(source, target, target_type, strategy, output_dir):
     'names' = similar names.
 
     Run all of them by default.
-    """
 
-    # TODO source should be a stream from wikidata
-    source_dataset = json.load(source)
-    LOGGER.info("Loaded source dataset '%s'", source.name)
+    Similar names and links are looked up via MySQL FULLTEXT queries by default,
+    or via a token index built in memory once with '--backend index'.
+    With '--backend minhash', similar links are instead the ones whose
+    tokens have a Jaccard similarity above '--minhash-threshold',
+    looked up in a MinHash index built in memory once, while similar
+    names still come from FULLTEXT queries.
+    Run 'linker minhash_recall' to tune the MinHash bands and rows.
+
+    The 'edit_distance' strategy expects {identifier: {string: [languages]}}
+    SOURCE files. Levenshtein and Damerau-Levenshtein candidates can come from
+    the deletion index built by 'importer import --deletion-index'.
+
+    With '--workers N', source items are matched by N processes,
+    each one with its own DB connections. The output does not change.
+
+    With '--stream', each SOURCE line must be a JSON object with source items,
+    e.g., {string: identifier}, and matches are dumped to '.jsonl' files,
+    one JSON object per line. With the 'all' strategy, a SOURCE that can only
+    be read once, e.g., '-' for the standard input, is first copied to a temporary file.
+
+    With '--cascade', 'all' runs 'perfect', then 'names' and 'links'
+    on the source items they did not resolve, from the cheapest to
+    the most expensive strategy. Matches are dumped to a single file,
+    tagged with the strategy that produced them.
+
+    With '--shared-candidates', 'all' fetches the target rows of each
+    bucket of source items once, then runs 'perfect' and 'names'
+    against them in memory. Only the FULLTEXT backend is affected.
+    """
+    # All the strategies, in cascade or not, read the source once each
+    source_items = _source_reader(source, stream, strategy == 'all')
     target_entity = target_database.get_entity(target, target_type)
     target_link_entity = target_database.get_link_entity(target, target_type)
+    use_index = backend == 'index'
+    minhash = (minhash_bands, minhash_rows,
+               minhash_threshold) if backend == 'minhash' else None
     if strategy == 'perfect':
-        _perfect_name_wrapper(source_dataset, target_entity, output_dir)
+        _perfect_name_wrapper(source_items, target_entity,
+                              output_dir, workers, stream)
     elif strategy == 'links':
-        _similar_links_wrapper(source_dataset, target_link_entity, output_dir)
+        _similar_links_wrapper(source_items, target_link_entity,
+                               output_dir, use_index, workers, stream, minhash)
     elif strategy == 'names':
-        _similar_names_wrapper(source_dataset, target_entity, output_dir)
+        _similar_names_wrapper(source_items, target_entity,
+                               output_dir, use_index, workers, stream)
     elif strategy == 'edit_distance':
-       # TODO create a command only for this matching technique to expose the edit distance function too
-        edit_distance_match(source_dataset, target_entity, 'jw', 0)
+        # TODO create a command only for this matching technique
+        _edit_distance_wrapper(source_items, target_entity, metric,
+                               threshold, output_dir, use_deletion_index, workers, stream)
+    elif strategy == 'all' and cascade:
+        LOGGER.info('Will run all the baseline strategies in cascade')
+        _cascade_wrapper(source_items, target_entity, target_link_entity,
+                         output_dir, use_index, workers, stream, shared_candidates, minhash)
     elif strategy == 'all':
         LOGGER.info('Will run all the baseline strategies')
-        _perfect_name_wrapper(source_dataset, target_entity, output_dir)
-        _similar_names_wrapper(source_dataset, target_entity, output_dir)
-        _similar_links_wrapper(source_dataset, target_link_entity, output_dir)
-
-
-def _similar_names_wrapper(source_dataset, target_dataset, output_dir):
+        if shared_candidates and not use_index:
+            _shared_candidates_wrapper(
+                source_items, target_entity, output_dir, workers, stream)
+        else:
+            _perfect_name_wrapper(source_items, target_entity,
+                                  output_dir, workers, stream)
+            _similar_names_wrapper(source_items, target_entity,
+                                   output_dir, use_index, workers, stream)
+        _similar_links_wrapper(source_items, target_link_entity,
+                               output_dir, use_index, workers, stream, minhash)
+
+
+def _source_reader(source, stream, multiple_passes=False):
+    """Return a function yielding the source items from the beginning at each call."""
+    if not stream:
+        # TODO source should be a stream from wikidata
+        source_dataset = json.load(source)
+        LOGGER.info("Loaded source dataset '%s'", source.name)
+        return source_dataset.items
+
+    name = source.name
+    if multiple_passes and not source.seekable():
+        # E.g., standard input can only be read once
+        LOGGER.info(
+            "Copying source dataset '%s' to a temporary file, since multiple strategies read it", name)
+        spool = tempfile.TemporaryFile('w+')
+        shutil.copyfileobj(source, spool)
+        source = spool
+
+    def read_lines():
+        # Multiple strategies read the same source
+        if source.seekable():
+            source.seek(0)
+        LOGGER.info("Streaming source dataset '%s'", name)
+        for line in source:
+            line = line.strip()
+            if line:
+                yield from json.loads(line).items()
+    return read_lines
+
+
+def _similar_names_wrapper(source_items, target_dataset, output_dir, use_index=False, workers=1, stream=False):
     LOGGER.info('Starting similar name match')
-    matches = similar_name_match(
-        source_dataset, target_dataset, text_utils.tokenize)
-    with open(path.join(output_dir, 'similar_name_matches.json'), 'w') as output_file:
-        json.dump(matches, output_file, indent=2, ensure_ascii=False)
-        LOGGER.info("Matches dumped to '%s'", output_file.name)
+    index = TokenIndex.build(target_dataset) if use_index else None
+    results = run_sharded(similar_name_stream, source_items(), workers,
+                          target_dataset, text_utils.tokenize, index)
+    if stream:
+        _dump_stream(results, output_dir, 'similar_name_matches.jsonl')
+    else:
+        _dump(_collect_similar_matches(results),
+              output_dir, 'similar_name_matches.json')
 
 
-def _similar_links_wrapper(source_dataset, target_entity, output_dir):
+def _similar_links_wrapper(source_items, target_entity, output_dir, use_index=False, workers=1, stream=False, minhash=None):
     LOGGER.info('Starting similar link match')
-    matches = similar_link_match(source_dataset, target_entity)
-    with open(path.join(output_dir, 'similar_link_matches.json'), 'w') as output_file:
-        json.dump(matches, output_file, indent=2, ensure_ascii=False)
-        LOGGER.info("Matches dumped to '%s'", output_file.name)
+    index = _build_link_index(target_entity, use_index, minhash)
+    results = run_sharded(similar_link_stream, source_items(),
+                          workers, target_entity, index)
+    if stream:
+        _dump_stream(results, output_dir, 'similar_link_matches.jsonl')
+    else:
+        _dump(_collect_similar_matches(results),
+              output_dir, 'similar_link_matches.json')
+
+
+def _build_link_index(target_link_entity, use_index, minhash):
+    if minhash:
+        return MinHashIndex.build(target_link_entity, *minhash)
+    if use_index:
+        return TokenIndex.build(target_link_entity)
+    return None
+
+
+def _edit_distance_wrapper(source_items, target_entity, metric, threshold, output_dir, use_deletion_index=False, workers=1, stream=False):
+    LOGGER.info('Starting edit distance match')
+    LOGGER.info('Using %s edit distance', EDIT_DISTANCES[metric].__name__)
+    index = DeletionIndex.load(deletion_index.index_path(
+        output_dir, target_entity)) if use_deletion_index else None
+    results = run_sharded(edit_distance_stream, source_items(), workers,
+                          target_entity, metric, threshold, index)
+    if stream:
+        _dump_stream(results, output_dir, 'edit_distance_matches.jsonl')
+    else:
+        _dump(dict(results), output_dir, 'edit_distance_matches.json')
+
+
+def _perfect_name_wrapper(source_items, target_entity, output_dir, workers=1, stream=False):
+    LOGGER.info('Starting perfect string match')
+    results = run_sharded(perfect_name_stream,
+                          source_items(), workers, target_entity)
+    if stream:
+        _dump_stream(((qid, catalog_id) for _, qid, catalog_id in results),
+                     output_dir, 'perfect_string_matches.jsonl')
+    else:
+        _dump(_collect_perfect_matches(results),
+              output_dir, 'perfect_string_matches.json')
+
+
+def _shared_candidates_wrapper(source_items, target_entity, output_dir, workers=1, stream=False):
+    LOGGER.info('Starting perfect string and similar name match with shared candidates')
+    results = run_sharded(shared_candidates_stream, source_items(), workers,
+                          target_entity, text_utils.tokenize)
+    if stream:
+        extension = '.jsonl'
+    else:
+        extension = '.json'
+        perfect_matches, name_matches = [], []
+    perfect_path = path.join(output_dir, 'perfect_string_matches' + extension)
+    names_path = path.join(output_dir, 'similar_name_matches' + extension)
+    # Both outputs come from one pass over the source items
+    with open(perfect_path, 'w', buffering=1) as perfect_file, open(names_path, 'w', buffering=1) as names_file:
+        for strategy, match in results:
+            if not stream:
+                (perfect_matches if strategy == 'perfect' else name_matches).append(match)
+            elif strategy == 'perfect':
+                _, qid, catalog_id = match
+                perfect_file.write(json.dumps(
+                    {qid: catalog_id}, ensure_ascii=False) + '\n')
+            else:
+                qid, catalog_ids = match
+                names_file.write(json.dumps(
+                    {qid: catalog_ids}, ensure_ascii=False) + '\n')
+        if not stream:
+            json.dump(_collect_perfect_matches(perfect_matches),
+                      perfect_file, indent=2, ensure_ascii=False)
+            json.dump(_collect_similar_matches(name_matches),
+                      names_file, indent=2, ensure_ascii=False)
+    LOGGER.info("Matches dumped to '%s' and '%s'", perfect_path, names_path)
+
+
+def _cascade_wrapper(source_items, target_entity, target_link_entity, output_dir, use_index=False, workers=1, stream=False, shared_candidates=False, minhash=None):
+    LOGGER.info('Starting cascade match')
+
+    def perfect(items):
+        for _, qid, catalog_id in run_sharded(perfect_name_stream, items, workers, target_entity):
+            yield 'perfect', qid, [catalog_id]
+
+    def names(items):
+        index = TokenIndex.build(target_entity) if use_index else None
+        for qid, catalog_ids in run_sharded(similar_name_stream, items, workers, target_entity, text_utils.tokenize, index):
+            yield 'names', qid, catalog_ids
+
+    def perfect_and_names(items):
+        for strategy, match in run_sharded(shared_candidates_stream, items, workers, target_entity, text_utils.tokenize, True):
+            if strategy == 'perfect':
+                _, qid, catalog_id = match
+                yield strategy, qid, [catalog_id]
+            else:
+                qid, catalog_ids = match
+                yield strategy, qid, catalog_ids
+
+    def links(items):
+        index = _build_link_index(target_link_entity, use_index, minhash)
+        for qid, catalog_ids in run_sharded(similar_link_stream, items, workers, target_link_entity, index):
+            yield 'links', qid, catalog_ids
+
+    if shared_candidates and not use_index:
+        stages = [('perfect+names', perfect_and_names), ('links', links)]
+    else:
+        stages = [('perfect', perfect), ('names', names), ('links', links)]
+    results = cascade_stream(source_items, stages)
+    if stream:
+        _dump_stream(results, output_dir, 'cascade_matches.jsonl')
+    else:
+        _dump(_collect_cascade_matches(results),
+              output_dir, 'cascade_matches.json')
+
+
+def cascade_stream(source_items, stages) -> Iterator[tuple]:
+    """Run matching stages one after the other, feeding each stage
+    only with the source items that previous stages did not resolve.
+
+    :param source_items: a function returning a fresh iterable of ``(string, identifier)`` pairs
+    :param stages: a list of ``(stage_name, stage)`` pairs, where ``stage`` is a function
+      taking an iterable of source items and yielding ``(strategy_name, identifier, [target_ids])`` triples
+    :return: a generator yielding ``(identifier, {'strategy': strategy_name, 'matches': [target_ids]})`` pairs
+    """
+    resolved = set()
+    for name, stage in stages:
+        # Items resolved by a stage only leave the following ones,
+        # so that the outcome does not depend on the stage internal order
+        newly_resolved = set()
+        skipped = 0
+
+        def unresolved():
+            nonlocal skipped
+            for label, qid in source_items():
+                if qid in resolved:
+                    skipped += 1
+                    continue
+                yield label, qid
+
+        for strategy, qid, catalog_ids in stage(unresolved()):
+            newly_resolved.add(qid)
+            yield qid, {'strategy': strategy, 'matches': catalog_ids}
+        LOGGER.info("Cascade stage '%s' resolved %d identifiers and skipped %d already resolved source items",
+                    name, len(newly_resolved), skipped)
+        resolved.update(newly_resolved)
+
+
+def _collect_cascade_matches(results):
+    matches = {}
+    for qid, tagged in results:
+        previous = matches.get(qid)
+        if previous:
+            rank = CASCADE_STRATEGIES.index(tagged['strategy'])
+            previous_rank = CASCADE_STRATEGIES.index(previous['strategy'])
+            # A stage running several strategies at once may also
+            # resolve an identifier with a more expensive one
+            if previous_rank < rank:
+                continue
+            if previous_rank == rank:
+                tagged['matches'] = sorted(
+                    set(previous['matches']).union(tagged['matches']))
+        matches[qid] = tagged
     return matches
 
 
-def _perfect_name_wrapper(source_dataset, target_entity, output_dir):
-    LOGGER.info('Starting perfect string match')
-    matches = perfect_name_match(source_dataset, target_entity)
-    with open(path.join(output_dir, 'perfect_string_matches.json'), 'w') as output_file:
+def _dump(matches, output_dir, file_name):
+    with open(path.join(output_dir, file_name), 'w') as output_file:
         json.dump(matches, output_file, indent=2, ensure_ascii=False)
         LOGGER.info("Matches dumped to '%s'", output_file.name)
 
 
+def _dump_stream(results, output_dir, file_name):
+    # Line buffering lets consumers read each match as soon as it is written
+    with open(path.join(output_dir, file_name), 'w', buffering=1) as output_file:
+        LOGGER.info("Streaming matches to '%s'", output_file.name)
+        count = 0
+        for key, value in results:
+            output_file.write(json.dumps(
+                {key: value}, ensure_ascii=False) + '\n')
+            count += 1
+        LOGGER.info("%d matches dumped to '%s'", count, output_file.name)
+
+
+def run_sharded(stream_function, source_items, workers, *args):
+    """Run ``stream_function(source_chunk, *args)`` over chunks of the source items
+    in a pool of ``workers`` processes and yield the results in source order.
+
+    Only a few chunks per worker are queued at a time,
+    so the source items can be a lazy stream.
+
+    Extra arguments, e.g., in-memory indices, are handed to each worker once
+    when the pool starts. With the default fork start method, workers share
+    them with the parent process instead of receiving a copy.
+    """
+    if workers <= 1:
+        yield from stream_function(source_items, *args)
+        return
+    LOGGER.info('Matching source chunks of %d items with %d workers',
+                WORKER_CHUNK_SIZE, workers)
+    # Workers add their own cache statistics: don't let them inherit the ones of this process
+    cache.flush_stats()
+    with Pool(workers, initializer=_init_worker, initargs=(stream_function, args)) as pool:
+        # Collecting chunk results in submission order makes the output deterministic
+        pending = deque()
+        for chunk in utils.stream_buckets(source_items, WORKER_CHUNK_SIZE):
+            pending.append(pool.apply_async(_match_chunk, (chunk,)))
+            if len(pending) >= WORKER_CHUNKS_QUEUE_SIZE * workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def _init_worker(stream_function, args):
+    global _WORKER_MATCH_FUNCTION, _WORKER_ARGS
+    _WORKER_MATCH_FUNCTION = stream_function
+    _WORKER_ARGS = args
+
+
+def _match_chunk(chunk):
+    try:
+        return list(_WORKER_MATCH_FUNCTION(chunk, *_WORKER_ARGS))
+    finally:
+        # Pool workers exit without running atexit hooks
+        cache.flush_stats()
+
+
+def _collect_perfect_matches(results):
+    matched = {}
+    for label, qid, catalog_id in results:
+        if matched.get(qid):
+            LOGGER.warning(
+                '%s - %s has already a perfect name match' % (qid, label))
+        matched[qid] = catalog_id
+    return matched
+
+
+def _collect_similar_matches(results):
+    matches = {}
+    for qid, catalog_ids in results:
+        matches[qid] = sorted(set(matches.get(qid, [])).union(catalog_ids))
+    return matches
+
+
 def perfect_name_match(source_dataset, target_entity: BaseEntity) -> dict:
     """Given an iterable of dictionaries ``{string: identifier}``,
     match perfect strings and return a dataset ``{id: id}``.
 
     This strategy applies to any object that can be
     treated as a string: names, links, etc.
-    """
-    matched = {}
 
-    for label, qid in source_dataset.items():
-        for res in data_gathering.perfect_name_search(target_entity, label):
-            if matched.get(qid):
-                LOGGER.warning(
-                    '%s - %s has already a perfect name match' % (qid, label))
-            matched[qid] = res.catalog_id
+    See :func:`perfect_name_stream`.
+    """
+    return _collect_perfect_matches(perfect_name_stream(source_dataset.items(), target_entity))
 
-    return matched
 
+def perfect_name_stream(source_items, target_entity: BaseEntity) -> Iterator[tuple]:
+    """Given an iterable of ``(string, identifier)`` pairs,
+    match perfect strings and yield ``(string, identifier, target_id)`` triples.
 
-def similar_link_match(source, target: BaseLinkEntity) -> dict:
+    Source strings are looked up in buckets of ``PERFECT_MATCH_BUCKET_SIZE``,
+    see :func:`soweego.commons.data_gathering.perfect_name_search_many`.
+    """
+    for bucket in utils.stream_buckets(source_items, PERFECT_MATCH_BUCKET_SIZE):
+        # The database tells which label each row matches
+        candidates = data_gathering.perfect_name_search_many(
+            target_entity, {(label, label) for label, _ in bucket}, ('catalog_id',))
+        for label, qid in bucket:
+            for res in candidates[label]:
+                yield label, qid, res.catalog_id
+
+
+def shared_candidates_stream(source_items, target_entity: BaseEntity, tokenize, cascade=False) -> Iterator[tuple]:
+    """Given an iterable of ``(string, identifier)`` pairs, run both
+    :func:`perfect_name_stream` and :func:`similar_name_stream`
+    and yield ``('perfect', (string, identifier, target_id))``
+    and ``('names', (identifier, [target_ids]))`` pairs.
+
+    The target rows with either a source string or a token of it are fetched
+    once per bucket of ``SHARED_CANDIDATES_BUCKET_SIZE`` source items,
+    then both strategies run against them in memory.
+
+    If ``cascade`` is set, similar names are skipped for identifiers
+    that got a perfect match in the same bucket.
+    """
+    for bucket in utils.stream_buckets(source_items, SHARED_CANDIDATES_BUCKET_SIZE):
+        labels, tokens = set(), set()
+        for label, _ in bucket:
+            if label:
+                labels.add(label)
+                tokens.update(tokenize(label))
+        # The database tells which label each perfect candidate matches
+        perfect_candidates, results = data_gathering.candidates_search(
+            target_entity, [(label, label) for label in labels], tokens)
+        index = TokenIndex.from_rows(
+            (res.catalog_id, res.tokens) for res in results)
+
+        perfect_qids = set()
+        for label, qid in bucket:
+            for res in perfect_candidates.get(label, ()):
+                perfect_qids.add(qid)
+                yield 'perfect', (label, qid, res.catalog_id)
+        if cascade:
+            bucket = [(label, qid)
+                      for label, qid in bucket if qid not in perfect_qids]
+        for match in similar_name_stream(bucket, target_entity, tokenize, index):
+            yield 'names', match
+
+
+def similar_link_match(source, target: BaseLinkEntity, index=None) -> dict:
     """Given a dictionaries ``{link: identifier} and a BaseLinkEntity``,
     match similar links and return a dataset ``{source_id: target_id}``.
 
@@ -125,60 +522,89 @@ def similar_link_match(source, target: BaseLinkEntity) -> dict:
     similarity means that a pair of links share a set of keywords.
 
     This strategy only applies to URLs.
+
+    Candidates come from FULLTEXT queries against ``target``,
+    or from the given :class:`TokenIndex` or :class:`MinHashIndex` of ``target`` if any.
     """
-    return similar_name_match(source, target, url_utils.tokenize)
+    return _collect_similar_matches(similar_link_stream(source.items(), target, index))
 
 
-def similar_name_match(source, target, tokenize) -> dict:
-    """Given a dictionaries ``{person_name: identifier}, a BaseEntity and a tokenization function``,
-    match similar names and return a dataset ``{source_id: target_id}``.
+def similar_link_stream(source_items, target: BaseLinkEntity, index=None) -> Iterator[tuple]:
+    """Streaming version of :func:`similar_link_match`."""
+    if isinstance(index, MinHashIndex):
+        return _minhash_link_stream(source_items, index)
+    return similar_name_stream(source_items, target, url_utils.tokenize, index)
 
-    This strategy only applies to people names.
-    """
-    matches = defaultdict(list)
-    to_exclude = set()
 
-    for label, qid in source.items():
-        if not label:
+def _minhash_link_stream(source_items, index):
+    for link, qid in source_items:
+        if not link:
             continue
+        tokenized = url_utils.tokenize(link)
+        # Same as similar names: sets of size 1 are always excluded
+        if not tokenized or len(tokenized) <= 1:
+            continue
+        matches = index.similar(tokenized)
+        if matches:
+            yield qid, sorted(matches)
 
-        to_exclude.clear()
 
-        tokenized = tokenize(label)
-        if len(tokenized) <= 1:
-            continue
+def similar_name_match(source, target, tokenize, index: TokenIndex = None) -> dict:
+    """Given a dictionaries ``{person_name: identifier}, a BaseEntity and a tokenization function``,
+    match similar names and return a dataset ``{source_id: target_id}``.
 
-        # NOTICE: sets of size 1 are always exluded
-        # Looks for sets equal or bigger containing our tokens
-        for res in data_gathering.tokens_fulltext_search(target, True, tokenized):
-            matches[qid].append(res.catalog_id)
-            to_exclude.add(res.catalog_id)
-        # Looks for sets contained in our set of tokens
-        for res in data_gathering.tokens_fulltext_search(target, False, tokenized):
-            res_tokenized = text_utils.tokenize(res.tokens)
-            if len(res_tokenized) > 1 and res_tokenized.issubset(tokenized):
-                matches[qid].append(res.catalog_id)
+    This strategy only applies to people names.
 
-        if matches[qid]:
-            matches[qid] = list(set(matches[qid]))
-        else:
-            del matches[qid]
+    See :func:`similar_name_stream`.
+    """
+    return _collect_similar_matches(similar_name_stream(source.items(), target, tokenize, index))
 
-    return matches
 
+def similar_name_stream(source_items, target, tokenize, index: TokenIndex = None) -> Iterator[tuple]:
+    """Given an iterable of ``(person_name, identifier)`` pairs, a BaseEntity and a tokenization function,
+    match similar names and yield ``(source_id, [target_ids])`` pairs.
 
-def edit_distance_match(source, target: BaseEntity, metric, threshold) -> dict:
+    Candidates come from FULLTEXT queries against ``target``,
+    sent in batches of ``data_gathering.FULLTEXT_BATCH_SIZE``,
+    or from the given :class:`TokenIndex` of ``target`` if any.
+    """
+    # NOTICE: sets of size 1 are always exluded
+    tokenized_items = ((qid, tokenized) for qid, tokenized in (
+        (qid, tokenize(label)) for label, qid in source_items if label) if tokenized and len(tokenized) > 1)
+
+    if index is not None:
+        for qid, tokenized in tokenized_items:
+            matches = index.superset(tokenized) | index.subset(tokenized)
+            if matches:
+                yield qid, sorted(matches)
+        return
+
+    for bucket in utils.stream_buckets(tokenized_items, data_gathering.FULLTEXT_BATCH_SIZE):
+        # The same QID may come with several names: key queries by position
+        keyed_tokens = [(position, tokenized)
+                        for position, (_, tokenized) in enumerate(bucket)]
+        # Looks for sets equal or bigger containing our tokens
+        supersets = data_gathering.tokens_fulltext_search_many(
+            target, True, keyed_tokens, SIMILAR_MATCH_COLUMNS)
+        # Looks for sets contained in our set of tokens
+        subsets = data_gathering.tokens_fulltext_search_many(
+            target, False, keyed_tokens, SIMILAR_MATCH_COLUMNS)
+        for position, (qid, tokenized) in enumerate(bucket):
+            matches = {res.catalog_id for res in supersets[position]}
+            results = subsets[position]
+            for res, res_tokenized in zip(results, text_utils.tokenize_many(res.tokens for res in results)):
+                if len(res_tokenized) > 1 and res_tokenized.issubset(tokenized):
+                    matches.add(res.catalog_id)
+            if matches:
+                yield qid, sorted(matches)
+
+
+def edit_distance_match(source, target: BaseEntity, metric, threshold, index: DeletionIndex = None) -> dict:
     """Given a source dataset ``{identifier: {string: [languages]}}``,
     match strings having the given edit distance ``metric``
     above the given ``threshold`` and return a dataset
     ``{source_id__target_id: distance_score}``.
 
-    Compute the distance for each ``(source, target)`` entity pair.
-    Target candidates are acquired as follows:
-    - build a query upon the most frequent source entity strings;
-    - exact strings are joined in an OR query, e.g., ``"string1" "string2"``;
-    - run the query against a database table containing indexed of target entities.
-
     ``distance_type`` can be one of:
 
     - ``jw``, `Jaro-Winkler <https://en.wikipedia.org/wiki/Jaro%E2%80%93Winkler_distance>`_;
@@ -186,8 +612,9 @@ def edit_distance_match(source, target: BaseEntity, metric, threshold) -> dict:
     - ``dl``, `Damerau-Levenshtein<https://en.wikipedia.org/wiki/Damerau%E2%80%93Levenshtein_distance>`_.
 
     Return ``None`` if the given edit distance is not valid.
+
+    See :func:`edit_distance_stream`.
     """
-    scores = {}
     distance_function = EDIT_DISTANCES.get(metric)
     if not distance_function:
         LOGGER.error(
@@ -196,48 +623,81 @@ def edit_distance_match(source, target: BaseEntity, metric, threshold) -> dict:
             'or "dl" (Damerau-Levenshtein)', metric)
         return None
     LOGGER.info('Using %s edit distance', distance_function.__name__)
-    for source_id, source_strings in source.items():
-        query, most_frequent_source_strings = _build_index_query(
-            source_strings)
-        LOGGER.debug('Query: %s', query)
-        target_candidates = data_gathering.name_fulltext_search(
-            target, query)
-        if target_candidates is None:
-            LOGGER.warning('Skipping query that went wrong: %s', query)
-            continue
-        if target_candidates == {}:
-            LOGGER.info('Skipping query with no results: %s', query)
-            continue
-        # This should be a very small loop, just 1 iteration most of the time
-        for source_string in most_frequent_source_strings:
-            source_ascii, source_normalized = text_utils.normalize(
-                source_string)
-            for result in target_candidates:
-                target_string = result.name
-                target_id = result.catalog_id
-                target_ascii, target_normalized = text_utils.normalize(
-                    target_string)
-                try:
-                    distance = distance_function(
-                        source_normalized, target_normalized)
-                # Damerau-Levenshtein does not support some Unicode code points
-                except ValueError:
-                    LOGGER.warning(
-                        'Skipping unsupported string in pair: "%s", "%s"',
-                        source_normalized, target_normalized)
-                    continue
-                LOGGER.debug('Source: %s > %s > %s - Target: %s > %s > %s - Distance: %f',
-                             source_string, source_ascii, source_normalized,
-                             target_string, target_ascii, target_normalized,
-                             distance)
-                if (metric in ('l', 'dl') and distance <= threshold) or (metric == 'jw' and distance >= threshold):
-                    scores['%s__%s' % (source_id, target_id)] = distance
-                    LOGGER.debug("It's a match! %s -> %s",
-                                 source_id, target_id)
-                else:
-                    LOGGER.debug('Skipping potential match due to the threshold: %s -> %s - Threshold: %f - Distance: %f',
-                                 source_id, target_id, threshold, distance)
-    return scores
+    return dict(edit_distance_stream(source.items(), target, metric, threshold, index))
+
+
+def edit_distance_stream(source_items, target: BaseEntity, metric, threshold, index: DeletionIndex = None) -> Iterator[tuple]:
+    """Given an iterable of ``(identifier, {string: [languages]})`` pairs,
+    match strings having the given edit distance ``metric``
+    above the given ``threshold`` and yield
+    ``(source_id__target_id, distance_score)`` pairs.
+
+    Compute the distance for each ``(source, target)`` entity pair.
+    Target candidates are acquired as follows:
+    - build a query upon the most frequent source entity strings;
+    - exact strings are joined in an OR query, e.g., ``"string1" "string2"``;
+    - run the query against a database table containing indexed of target entities,
+      together with the queries of ``data_gathering.FULLTEXT_BATCH_SIZE`` source entities.
+
+    If a :class:`DeletionIndex` of the target is given, Levenshtein and Damerau-Levenshtein
+    candidates are instead the target strings within the ``threshold`` distance
+    from the most frequent source entity strings.
+
+    :raises ValueError: if the given edit distance is not valid
+    """
+    distance_function = EDIT_DISTANCES.get(metric)
+    if not distance_function:
+        raise ValueError('Invalid edit distance: "%s". Please pick one of %s' % (
+            metric, list(EDIT_DISTANCES.keys())))
+    if index is not None and not index.supports(metric, threshold):
+        LOGGER.warning(
+            'The deletion index cannot serve %s edit distance with threshold %s, will use FULLTEXT queries', metric, threshold)
+        index = None
+    if index is not None:
+        for source_id, source_strings in source_items:
+            query, most_frequent_source_strings = _build_index_query(
+                source_strings)
+            LOGGER.debug('Query: %s', query)
+            target_candidates = list({candidate for source_string in most_frequent_source_strings
+                                      for candidate in index.lookup(source_string, metric, threshold)})
+            yield from _edit_distance_matches(source_id, query, most_frequent_source_strings,
+                                              target_candidates, metric, threshold)
+        return
+
+    for bucket in utils.stream_buckets(source_items, data_gathering.FULLTEXT_BATCH_SIZE):
+        queries = [(source_id, _build_index_query(source_strings))
+                   for source_id, source_strings in bucket]
+        # The same identifier may come twice: key queries by position
+        candidates = data_gathering.name_fulltext_search_many(
+            target, ((position, query) for position, (_, (query, _)) in enumerate(queries)), EDIT_DISTANCE_COLUMNS)
+        for position, (source_id, (query, most_frequent_source_strings)) in enumerate(queries):
+            LOGGER.debug('Query: %s', query)
+            yield from _edit_distance_matches(source_id, query, most_frequent_source_strings,
+                                              candidates[position], metric, threshold)
+
+
+def _edit_distance_matches(source_id, query, most_frequent_source_strings, target_candidates, metric, threshold):
+    if not target_candidates:
+        LOGGER.info('Skipping query with no results: %s', query)
+        return
+    distance_function = EDIT_DISTANCES[metric]
+    # Normalize target strings once for all the source strings
+    target_normalized = [lowercase for _, lowercase in text_utils.normalize_many(
+        result.name for result in target_candidates)]
+    # This should be a very small loop, just 1 iteration most of the time
+    for source_string in most_frequent_source_strings:
+        _, source_normalized = text_utils.normalize(source_string)
+        distances = distance_function(
+            source_normalized, target_normalized, threshold)
+        # Skipped pairs have a NaN distance, which never passes the threshold
+        if metric == 'jw':
+            passed = numpy.flatnonzero(distances >= threshold)
+        else:
+            passed = numpy.flatnonzero(distances <= threshold)
+        for i in passed:
+            yield '%s__%s' % (source_id, target_candidates[i].catalog_id), distances[i].item()
+        LOGGER.debug('%s: %d matches out of %d candidates for "%s"',
+                     source_id, len(passed), len(target_candidates), source_normalized)
 
 
 def _build_index_query(source_strings):
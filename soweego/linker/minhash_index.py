@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""In-memory MinHash locality-sensitive hashing index over the tokens of a target link table"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import json
+import logging
+from array import array
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable
+from zlib import crc32
+
+import click
+import numpy
+from soweego.commons import data_gathering, target_database, text_utils, utils
+from soweego.linker.token_index import TOKENIZE_BUCKET_SIZE
+
+LOGGER = logging.getLogger(__name__)
+
+# Mersenne prime 2^31 - 1: hash products fit into 64 bits
+MERSENNE_PRIME = (1 << 31) - 1
+# 32 bands of 4 rows: pairs with a Jaccard similarity of 0.5
+# become candidates with a probability of about 0.87
+DEFAULT_BANDS = 32
+DEFAULT_ROWS = 4
+DEFAULT_THRESHOLD = 0.5
+# Fixed seed: signatures must not change across processes and runs
+SEED = 1984
+
+
+class MinHashIndex():
+
+    """Map bands of MinHash signatures to the rows sharing them.
+
+    Rows whose token sets have a Jaccard similarity ``s`` share at least
+    one band with probability ``1 - (1 - s^rows)^bands``, so each lookup
+    only verifies a few candidates instead of scanning the table.
+    Candidates are then kept if their exact Jaccard similarity
+    with the query reaches the index ``threshold``.
+    """
+
+    def __init__(self, bands=DEFAULT_BANDS, rows=DEFAULT_ROWS, threshold=DEFAULT_THRESHOLD):
+        if bands < 1 or rows < 1:
+            raise ValueError(
+                'Bands and rows must be positive, got %d and %d' % (bands, rows))
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        random_state = numpy.random.RandomState(SEED)
+        self._a = random_state.randint(
+            1, MERSENNE_PRIME, size=bands * rows).astype(numpy.uint64)
+        self._b = random_state.randint(
+            0, MERSENNE_PRIME, size=bands * rows).astype(numpy.uint64)
+        self._catalog_ids = []
+        self._token_sets = []
+        self._buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._catalog_ids)
+
+    @classmethod
+    def build(cls, target_link_entity, bands=DEFAULT_BANDS, rows=DEFAULT_ROWS, threshold=DEFAULT_THRESHOLD) -> 'MinHashIndex':
+        """Build the index from the ``tokens`` column of the given ``BaseLinkEntity`` table."""
+        LOGGER.info('Building the MinHash index of %s with %d bands of %d rows ...',
+                    target_link_entity.__tablename__, bands, rows)
+        start = datetime.now()
+        index = cls.from_rows(data_gathering.gather_target_tokens(
+            target_link_entity), bands, rows, threshold)
+        LOGGER.info('MinHash index of %s built in %s: %d rows',
+                    target_link_entity.__tablename__, datetime.now() - start, len(index))
+        return index
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple], bands=DEFAULT_BANDS, rows_per_band=DEFAULT_ROWS, threshold=DEFAULT_THRESHOLD) -> 'MinHashIndex':
+        """Build the index from ``(catalog_id, tokens)`` pairs."""
+        index = cls(bands, rows_per_band, threshold)
+        buckets = [defaultdict(lambda: array('I')) for _ in range(bands)]
+        for bucket in utils.stream_buckets(rows, TOKENIZE_BUCKET_SIZE):
+            # Discogs joins link tokens with '|', MusicBrainz with spaces
+            token_sets = text_utils.tokenize_many(
+                tokens or '' for _, tokens in bucket)
+            for (catalog_id, _), row_tokens in zip(bucket, token_sets):
+                if not row_tokens:
+                    continue
+                row = len(index._catalog_ids)
+                index._catalog_ids.append(catalog_id)
+                index._token_sets.append(row_tokens)
+                for band, key in enumerate(index._band_keys(row_tokens)):
+                    buckets[band][key].append(row)
+        index._buckets = [dict(band) for band in buckets]
+        return index
+
+    def similar(self, tokens: Iterable[str]) -> set:
+        """Return the catalog identifiers of rows whose tokens have
+        a Jaccard similarity with the given ones of at least ``threshold``.
+        """
+        query = self._canonicalize(tokens)
+        if not query:
+            return set()
+        candidates = set()
+        for band, key in enumerate(self._band_keys(query)):
+            candidates.update(self._buckets[band].get(key, ()))
+        matches = set()
+        for row in candidates:
+            row_tokens = self._token_sets[row]
+            intersection = len(query & row_tokens)
+            if intersection / (len(query) + len(row_tokens) - intersection) >= self.threshold:
+                matches.add(self._catalog_ids[row])
+        return matches
+
+    def signature(self, tokens: frozenset) -> numpy.ndarray:
+        """Compute the MinHash signature of a non-empty set of tokens."""
+        # CRC32 is stable across processes, unlike the built-in hash
+        hashes = numpy.fromiter((crc32(token.encode('utf-8')) % MERSENNE_PRIME for token in tokens),
+                                dtype=numpy.uint64, count=len(tokens))
+        permuted = (numpy.outer(self._a, hashes) +
+                    self._b[:, None]) % MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+    def _band_keys(self, tokens):
+        signature = self.signature(tokens)
+        for band in range(self.bands):
+            yield signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    @staticmethod
+    def _canonicalize(tokens):
+        # Query tokens undergo the same pipeline as the indexed ones
+        return frozenset(text_utils.tokenize(' '.join(tokens)))
+
+
+def candidate_probability(similarity: float, bands: int, rows: int) -> float:
+    """Probability that two sets with the given Jaccard similarity share a band."""
+    return 1 - (1 - similarity ** rows) ** bands
+
+
+@click.command()
+@click.argument('source', type=click.File())
+@click.argument('target', type=click.Choice(target_database.available_targets()))
+@click.argument('target_type', type=click.Choice(target_database.available_types()))
+@click.option('--bands', type=click.IntRange(min=1), default=DEFAULT_BANDS,
+              help='Number of MinHash bands. Default: %d.' % DEFAULT_BANDS)
+@click.option('--rows', type=click.IntRange(min=1), default=DEFAULT_ROWS,
+              help='Number of MinHash rows per band. Default: %d.' % DEFAULT_ROWS)
+@click.option('--threshold', type=click.FloatRange(0, 1), default=DEFAULT_THRESHOLD,
+              help='Minimum Jaccard similarity of a match. Default: %s.' % DEFAULT_THRESHOLD)
+@click.option('--sample', type=click.IntRange(min=1), default=1000,
+              help='Number of source links to evaluate. Default: 1000.')
+def minhash_recall(source, target, target_type, bands, rows, threshold, sample):
+    """Compare MinHash link matches against FULLTEXT ones.
+
+    SOURCE must be a {link: identifier} JSON file.
+
+    Report the share of FULLTEXT matches that the MinHash index also finds,
+    the amount of MinHash matches that FULLTEXT does not find,
+    and the time spent by both.
+    """
+    # Avoid a circular import: the linking strategies use this index
+    from soweego.linker.linking_strategies import similar_link_stream
+
+    source_items = list(json.load(source).items())[:sample]
+    target_link_entity = target_database.get_link_entity(target, target_type)
+    index = MinHashIndex.build(target_link_entity, bands, rows, threshold)
+
+    start = datetime.now()
+    fulltext_pairs = {(qid, tid) for qid, tids in similar_link_stream(
+        source_items, target_link_entity) for tid in tids}
+    fulltext_time = datetime.now() - start
+    start = datetime.now()
+    minhash_pairs = {(qid, tid) for qid, tids in similar_link_stream(
+        source_items, target_link_entity, index) for tid in tids}
+    minhash_time = datetime.now() - start
+
+    found = len(fulltext_pairs & minhash_pairs)
+    click.echo('Source links: %d, bands: %d, rows: %d, Jaccard threshold: %s' % (
+        len(source_items), bands, rows, threshold))
+    click.echo('Candidate probability at the threshold: %.3f' %
+               candidate_probability(threshold, bands, rows))
+    click.echo('FULLTEXT matches: %d in %s' %
+               (len(fulltext_pairs), fulltext_time))
+    click.echo('MinHash matches: %d in %s' %
+               (len(minhash_pairs), minhash_time))
+    click.echo('Recall against FULLTEXT: %.3f' %
+               (found / len(fulltext_pairs) if fulltext_pairs else 1))
+    click.echo('MinHash matches not found by FULLTEXT: %d' %
+               (len(minhash_pairs) - found))
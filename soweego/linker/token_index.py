@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""In-memory inverted index over the tokens of a target catalog table"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import logging
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Iterable
+
+from soweego.commons import data_gathering, text_utils, utils
+
+LOGGER = logging.getLogger(__name__)
+
+# Amount of rows tokenized together
+TOKENIZE_BUCKET_SIZE = 10000
+
+
+class TokenIndex():
+
+    """Map each token to the sorted list of rows containing it.
+
+    Rows are identified by their position in the index,
+    so postings are stored as compact unsigned integer arrays.
+    A row is the set of tokens of one target entry, e.g., a name variation.
+    """
+
+    def __init__(self):
+        self._catalog_ids = []
+        self._row_sizes = array('I')
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._catalog_ids)
+
+    @classmethod
+    def build(cls, target_entity) -> 'TokenIndex':
+        """Build the index from the ``tokens`` column of
+        the given ``BaseEntity`` or ``BaseLinkEntity`` table.
+        """
+        LOGGER.info('Building the token index of %s ...',
+                    target_entity.__tablename__)
+        start = datetime.now()
+        index = cls.from_rows(
+            data_gathering.gather_target_tokens(target_entity))
+        LOGGER.info('Token index of %s built in %s: %d rows, %d distinct tokens',
+                    target_entity.__tablename__, datetime.now() - start, len(index), len(index._postings))
+        return index
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]) -> 'TokenIndex':
+        """Build the index from ``(catalog_id, tokens)`` pairs."""
+        index = cls()
+        postings = defaultdict(lambda: array('I'))
+        for bucket in utils.stream_buckets(rows, TOKENIZE_BUCKET_SIZE):
+            # Name variations often repeat the same tokens
+            token_sets = text_utils.tokenize_many(
+                tokens or '' for _, tokens in bucket)
+            for (catalog_id, _), row_tokens in zip(bucket, token_sets):
+                if not row_tokens:
+                    continue
+                row = len(index._catalog_ids)
+                index._catalog_ids.append(catalog_id)
+                index._row_sizes.append(len(row_tokens))
+                for token in row_tokens:
+                    postings[token].append(row)
+        index._postings = dict(postings)
+        return index
+
+    def superset(self, tokens: Iterable[str]) -> set:
+        """Return the catalog identifiers of rows containing all the given tokens.
+
+        Equivalent to a boolean FULLTEXT query ``+token1 +token2 ...``.
+        """
+        query = self._canonicalize(tokens)
+        if not query:
+            return set()
+        postings = []
+        for token in query:
+            posting = self._postings.get(token)
+            if posting is None:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        shortest, others = postings[0], postings[1:]
+        return {self._catalog_ids[row] for row in shortest
+                if all(_contains(posting, row) for posting in others)}
+
+    def subset(self, tokens: Iterable[str]) -> set:
+        """Return the catalog identifiers of rows with more than one token,
+        all of them contained in the given tokens.
+        """
+        query = self._canonicalize(tokens)
+        hits = Counter()
+        for token in query:
+            hits.update(self._postings.get(token, ()))
+        return {self._catalog_ids[row] for row, count in hits.items()
+                if count > 1 and count == self._row_sizes[row]}
+
+    @staticmethod
+    def _canonicalize(tokens):
+        # Query tokens undergo the same pipeline as the indexed ones
+        return text_utils.tokenize(' '.join(tokens))
+
+
+def _contains(posting, row):
+    position = bisect_left(posting, row)
+    return position < len(posting) and posting[position] == row
@@ -57,19 +57,19 @@ def check_existence_cli(wikidata_query, class_qid, catalog_pid, catalog, entity_
 
 def check_existence(class_or_occupation_query, class_qid, catalog_pid, entity: BaseEntity):
     query_type = 'identifier', class_or_occupation_query
-    session = DBManager.connect_to_db()
     invalid = defaultdict(set)
     count = 0
 
-    for result in sparql_queries.run_identifier_or_links_query(query_type, class_qid, catalog_pid, 0):
-        for qid, target_id in result.items():
-            results = session.query(entity).filter(
-                entity.catalog_id == target_id).all()
-            if not results:
-                LOGGER.warning(
-                    '%s identifier %s is invalid', qid, target_id)
-                invalid[target_id].add(qid)
-                count += 1
+    with DBManager.session_scope() as session:
+        for result in sparql_queries.run_identifier_or_links_query(query_type, class_qid, catalog_pid, 0):
+            for qid, target_id in result.items():
+                results = session.query(entity).filter(
+                    entity.catalog_id == target_id).all()
+                if not results:
+                    LOGGER.warning(
+                        '%s identifier %s is invalid', qid, target_id)
+                    invalid[target_id].add(qid)
+                    count += 1
 
     LOGGER.info('Total invalid identifiers = %d', count)
     # Sets are not serializable to JSON, so cast them to lists
@@ -105,6 +105,9 @@ def check_links_cli(entity, catalog, wikidata_dump, upload, sandbox, cache, depr
         wikidata_cache = _load_wikidata_cache(cache)
         to_deprecate, ext_ids_to_add, urls_to_add, wikidata_links = check_links(
             entity, catalog, wikidata_cache)
+    # No target links
+    if to_deprecate is None:
+        return
 
     if wikidata_dump:
         json.dump({qid: {data_type: list(values) for data_type, values in data.items()}
@@ -131,17 +134,17 @@ def check_links(entity, catalog, wikidata_cache=None):
     target = gather_target_links(entity, catalog)
     # Early stop in case of no target links
     if target is None:
-        return None, None, None
+        return None, None, None, None
 
     to_deprecate = defaultdict(set)
     to_add = defaultdict(set)
 
+    url_pids, ext_id_pids_to_urls = gather_relevant_pids()
     if wikidata_cache is None:
         wikidata = {}
 
         # Wikidata links
         gather_identifiers(entity, catalog, catalog_terms['pid'], wikidata)
-        url_pids, ext_id_pids_to_urls = gather_relevant_pids()
         gather_wikidata_links(wikidata, url_pids, ext_id_pids_to_urls)
     else:
         wikidata = wikidata_cache
@@ -186,6 +189,9 @@ def check_metadata_cli(entity, catalog, wikidata_dump, upload, sandbox, cache, d
     else:
         to_deprecate, to_add, wikidata_metadata = check_metadata(
             entity, catalog)
+    # No target metadata
+    if to_deprecate is None:
+        return
 
     if wikidata_dump:
         json.dump({qid: {data_type: list(values) for data_type, values in data.items()}
@@ -12,11 +12,15 @@ __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Iterator
 from urllib.parse import urlunsplit
 
-from requests import get
-from requests.exceptions import ChunkedEncodingError
+import requests.exceptions
+from requests import Session
+from requests.adapters import HTTPAdapter
 
 from soweego.commons.logging import log_request_data
 from soweego.wikidata.vocabulary import METADATA_PIDS
@@ -25,16 +29,28 @@ LOGGER = logging.getLogger(__name__)
 
 WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
 BUCKET_SIZE = 50
+# Concurrent requests to the Wikidata API
+WORKERS = 4
+# Seconds of database replication lag above which the API refuses requests,
+# see https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+MAXLAG = 5
+# Attempts per request, and seconds to wait before the first retry,
+# doubled at each further one
+MAX_RETRIES = 6
+BACKOFF_SECONDS = 2
+# HTTP requests timeout in seconds
+READ_TIMEOUT = 60
+# Transient HTTP failures worth a retry
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_local = threading.local()
 
 
 def get_metadata(qids: set) -> Iterator[tuple]:
     no_claims_count = 0
 
     qid_buckets, request_params = _prepare_request(qids, 'claims')
-    for bucket in qid_buckets:
-        response_body = _make_request(bucket, request_params)
-        if not response_body:
-            continue
+    for response_body in _fetch_buckets(qid_buckets, request_params):
         for qid in response_body['entities']:
             claims = response_body['entities'][qid].get('claims')
             if not claims:
@@ -66,10 +82,7 @@ def get_links(qids: set, url_pids: set, ext_id_pids_to_urls: dict) -> Iterator[t
     no_ext_ids_count = 0
 
     qid_buckets, request_params = _prepare_request(qids, 'sitelinks|claims')
-    for bucket in qid_buckets:
-        response_body = _make_request(bucket, request_params)
-        if not response_body:
-            continue
+    for response_body in _fetch_buckets(qid_buckets, request_params):
         for qid in response_body['entities']:
             entity = response_body['entities'][qid]
             # Sitelinks
@@ -151,28 +164,99 @@ def _prepare_request(qids, props):
     return qid_buckets, request_params
 
 
+def _fetch_buckets(qid_buckets, params) -> Iterator[dict]:
+    """Request the buckets of QIDs with ``WORKERS`` concurrent requests,
+    and yield the response bodies in completion order, skipping failed ones.
+    """
+    buckets = iter(qid_buckets)
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        # Keep a few requests queued, without submitting all the buckets upfront
+        pending = {executor.submit(_make_request, bucket, params)
+                   for bucket in _take(buckets, 2 * WORKERS)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.update(executor.submit(_make_request, bucket, params)
+                           for bucket in _take(buckets, len(done)))
+            for future in done:
+                response_body = future.result()
+                if response_body:
+                    yield response_body
+
+
+def _take(iterator, amount):
+    for _ in range(amount):
+        item = next(iterator, None)
+        if item is None:
+            return
+        yield item
+
+
+def _get_session():
+    # One session per thread: keep-alive connections are reused across requests
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = Session()
+        session.headers.update({'Accept-Encoding': 'gzip'})
+        session.mount('https://', HTTPAdapter(pool_maxsize=1))
+        _local.session = session
+    return session
+
+
 def _make_request(bucket, params):
-    params['ids'] = '|'.join(bucket)
-    connection_is_ok = True
-    while True:
+    params = dict(params, ids='|'.join(bucket), maxlag=MAXLAG)
+    session = _get_session()
+    for attempt in range(MAX_RETRIES):
         try:
-            response = get(WIKIDATA_API_URL, params=params)
+            response = session.get(
+                WIKIDATA_API_URL, params=params, timeout=READ_TIMEOUT)
             log_request_data(response, LOGGER)
-        except ChunkedEncodingError:
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as error:
             LOGGER.warning(
-                'Connection broken, retrying the request to the Wikidata API')
-            connection_is_ok = False
-        else:
-            connection_is_ok = True
-        if connection_is_ok:
-            break
-    if not response.ok:
-        LOGGER.warning('Skipping failed %s to the Wikidata API. Reason: %d %s - Full URL: %s',
-                       response.request.method, response.status_code, response.reason, response.request.url)
-        return None
-    LOGGER.debug(
-        'Successful %s to the Wikidata API. Status code: %d', response.request.method, response.status_code)
-    return response.json()
+                'Connection broken, retrying the request to the Wikidata API. Reason: %s', error)
+            _back_off(attempt)
+            continue
+        if response.status_code in RETRY_STATUS_CODES:
+            LOGGER.warning('Retrying failed %s to the Wikidata API. Reason: %d %s',
+                           response.request.method, response.status_code, response.reason)
+            _back_off(attempt, response.headers.get('Retry-After'))
+            continue
+        if not response.ok:
+            LOGGER.warning('Skipping failed %s to the Wikidata API. Reason: %d %s - Full URL: %s',
+                           response.request.method, response.status_code, response.reason, response.request.url)
+            return None
+        try:
+            response_body = response.json()
+        except ValueError as error:
+            # E.g., an HTML error page or a truncated body from a proxy
+            LOGGER.warning(
+                'Retrying the request to the Wikidata API, since the response body is not JSON. Reason: %s', error)
+            _back_off(attempt)
+            continue
+        # Lagged requests succeed with an error body
+        if response_body.get('error', {}).get('code') == 'maxlag':
+            LOGGER.info('Wikidata is lagged, retrying the request. Reason: %s',
+                        response_body['error'].get('info'))
+            _back_off(attempt, response.headers.get('Retry-After'))
+            continue
+        LOGGER.debug(
+            'Successful %s to the Wikidata API. Status code: %d', response.request.method, response.status_code)
+        return response_body
+    LOGGER.error('Giving up the request to the Wikidata API after %d attempts. QIDs: %s',
+                 MAX_RETRIES, params['ids'])
+    return None
+
+
+def _back_off(attempt, retry_after=None):
+    # No point in waiting after the last attempt
+    if attempt + 1 >= MAX_RETRIES:
+        return
+    # Honor the server hint, if any
+    try:
+        seconds = max(int(retry_after), 1)
+    except (TypeError, ValueError):
+        seconds = BACKOFF_SECONDS * 2 ** attempt
+    time.sleep(seconds)
 
 
 def _extract_value_from_claim(pid_claim, pid, qid):
@@ -238,7 +322,8 @@ def _make_buckets(qids):
         if len(current_bucket) >= BUCKET_SIZE:
             buckets.append(current_bucket)
             current_bucket = []
-    buckets.append(current_bucket)
+    if current_bucket:
+        buckets.append(current_bucket)
     LOGGER.info('Made %d buckets of size %d out of %d QIDs to comply with the Wikidata API limits',
                 len(buckets), BUCKET_SIZE, len(qids))
     return buckets
@@ -12,7 +12,7 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 
 import click
 
-from soweego.wikidata import sample_additional_info, sparql_queries
+from soweego.wikidata import pid_registry, sample_additional_info, sparql_queries
 
 CLI_COMMANDS = {
     'class_based_identifier_query': sparql_queries.identifier_class_based_query_cli,
@@ -23,7 +23,8 @@ CLI_COMMANDS = {
     'get_birth_death_dates_for_sample':
         sample_additional_info.get_birth_death_dates_for_sample,
     'get_url_formatters_for_properties':
-        sample_additional_info.get_url_formatters_for_properties
+        sample_additional_info.get_url_formatters_for_properties,
+    'refresh_pids': pid_registry.refresh_pids_cli
 }
 
 
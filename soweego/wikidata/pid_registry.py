@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Snapshot of the Wikidata properties needed to handle links:
+PIDs with URL values, and formatter URLs and regexes of external identifier PIDs.
+
+Gathering them takes two queries against the live SPARQL endpoint,
+so they are stored on disk, in the folder shared across runs, and loaded from there.
+Refresh the snapshot with ``wikidata refresh_pids``.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2018, Hjfocs'
+
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from functools import lru_cache
+
+import click
+from soweego.commons import cache, url_utils
+from soweego.wikidata import sparql_queries
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_PATH = os.path.join(cache.SHARED_DIR, 'pid_registry.json')
+# Bump when the snapshot layout changes: older snapshots are refreshed
+FORMAT_VERSION = 1
+
+
+@lru_cache(maxsize=1)
+def load(path=REGISTRY_PATH) -> tuple:
+    """Load the snapshot.
+    If it is missing or has an outdated format, warn and create it from the live endpoint.
+
+    :return: the set of PIDs with URL values,
+     and a :class:`soweego.commons.url_utils.FormatterIndex` of external identifier PIDs,
+     whose regexes are compiled on first use
+    :rtype: tuple
+    """
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        LOGGER.warning("No PID registry snapshot in '%s': querying the Wikidata SPARQL endpoint to create it. "
+                       "Create it upfront with 'wikidata refresh_pids'", path)
+        snapshot = refresh(path)
+    else:
+        if snapshot.get('format_version') != FORMAT_VERSION:
+            LOGGER.warning("PID registry snapshot in '%s' has format version %s, expected %d: "
+                           "querying the Wikidata SPARQL endpoint to refresh it", path,
+                           snapshot.get('format_version'), FORMAT_VERSION)
+            snapshot = refresh(path)
+    LOGGER.info('Loaded PID registry snapshot created on %s: %d URL PIDs, %d external ID PIDs',
+                snapshot['created'], len(snapshot['url_pids']), len(snapshot['ext_id_pids_to_urls']))
+    return frozenset(snapshot['url_pids']), url_utils.FormatterIndex(snapshot['ext_id_pids_to_urls'])
+
+
+def refresh(path=REGISTRY_PATH) -> dict:
+    """Query the Wikidata SPARQL endpoint and store a new snapshot.
+
+    :return: the snapshot
+    :rtype: dict
+    """
+    url_pids = sorted(set(sparql_queries.url_pids_query()))
+    formatters = url_utils.FormatterIndex.from_results(
+        sparql_queries.external_id_pids_and_urls_query())
+    snapshot = {
+        'format_version': FORMAT_VERSION,
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'url_pids': url_pids,
+        'ext_id_pids_to_urls': {pid: formatters[pid] for pid in sorted(formatters)}
+    }
+    # Write to a temporary file first, so readers never see a partial snapshot
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            json.dump(snapshot, temp_file, indent=2, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    load.cache_clear()
+    LOGGER.info("PID registry snapshot stored in '%s'", path)
+    return snapshot
+
+
+@click.command()
+def refresh_pids_cli():
+    """Refresh the snapshot of URL and external identifier PIDs."""
+    snapshot = refresh()
+    click.echo('%d URL PIDs, %d external ID PIDs with %d formatter URLs stored in %s' % (
+        len(snapshot['url_pids']), len(snapshot['ext_id_pids_to_urls']),
+        sum(len(formatters)
+            for formatters in snapshot['ext_id_pids_to_urls'].values()),
+        REGISTRY_PATH))
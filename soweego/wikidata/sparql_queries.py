@@ -15,7 +15,6 @@ import json
 import logging
 import os
 from csv import DictReader
-from functools import lru_cache
 from re import search
 from typing import Iterator
 
@@ -95,7 +94,6 @@ def identifier_class_based_query_cli(ontology_class, identifier_property, result
             "Class-based identifier query result dumped as JSON lines to '%s'", outfile.name)
 
 
-@lru_cache()
 def run_identifier_or_links_query(query_type: tuple, class_qid: str, catalog_pid: str, result_per_page: int) -> Iterator[dict]:
     """Run a filled SPARQL query template against the Wikidata endpoint with eventual paging.
 
@@ -139,7 +137,6 @@ def catalog_qid_query(catalog_pid):
         yield valid_qid.group()
 
 
-@lru_cache()
 def url_pids_query():
     LOGGER.info('Retrieving PIDs with URL values')
     result_set = make_request(URL_PIDS_QUERY)
@@ -150,7 +147,6 @@ def url_pids_query():
         yield valid_pid.group()
 
 
-@lru_cache()
 def external_id_pids_and_urls_query():
     LOGGER.info(
         'Retrieving PIDs with external ID values, their formatter URLs and regexps')